@@ -0,0 +1,97 @@
+"""正文清洗和文件名生成的微基准，语料是 mblog_texts.json 中接口返回的 mblog.text 样例
+
+同时对比旧版四次 re.sub 的实现，确认新实现对每条样例的输出完全相同。文件名按实际保存时的做法
+在临时状态库里登记归属（每条都是新微博），旧版不检查重名，两者的差值就是防重名的开销。示例:
+    python bench/bench_text.py
+    python bench/bench_text.py --repeat 2000 --json
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import weibo_downloader as wd  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mblog_texts.json")
+
+def legacy_clean_content(content):
+    """旧版实现：对整条 HTML 做四次 re.sub 后只取前 20 个字符"""
+    content = re.sub(r'<[^>]+>', '', content)
+    content = re.sub(r'[\n\r]', ' ', content)
+    cleaned = re.sub(r'[^\u4e00-\u9fa5a-zA-Z0-9_\s-]', '', content)
+    cleaned = re.sub(r'\s+', ' ', cleaned).rstrip()
+    return cleaned[:20].rstrip()
+
+def legacy_valid_filename(name):
+    name = re.sub(r'[\\/*?:"<>|\n\r]', '', name)
+    return name.rstrip()
+
+def legacy_names(post_time, content):
+    """旧版 save_weibo 中每条微博最多计算三次文件名"""
+    return [f"{post_time}-{legacy_valid_filename(content)}{suffix}" for suffix in ("", ".mp4", ".txt")]
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="正文清洗和文件名生成的微基准")
+    parser.add_argument("--repeat", type=int, default=500, help="语料重复处理的次数")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    return parser
+
+def measure(function, items, repeat):
+    """返回每次调用的平均耗时（微秒）"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            function(*item)
+    return (time.perf_counter() - start) / (repeat * len(items)) * 1e6
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    with open(CORPUS, 'r', encoding='utf-8') as f:
+        texts = json.load(f)
+    mismatched = [text for text in texts if wd.WeiboUtils.clean_content(text) != legacy_clean_content(text)]
+    if mismatched:
+        print(f"新旧实现输出不一致:{mismatched[0]!r}", file=sys.stderr)
+        return 1
+    posts = [wd.Post(f"2024-01-01-00-00-{number % 60:02d}", wd.WeiboUtils.clean_content(text), [], None, "",
+                     f"B{number}", False, "") for number, text in enumerate(texts)]
+    # 每轮换一批 bid，和抓取新微博时一样每次都要新登记
+    new_posts = [(wd.Post(post.time, post.content, [], None, "", f"{post.bid}-{round_}", False, ""),)
+                 for round_ in range(args.repeat) for post in posts]
+    save_dir = tempfile.mkdtemp(prefix="weibo-bench-text-")
+    store = wd.StateStore(save_dir)
+    try:
+        start = time.perf_counter()
+        for (post,) in new_posts:
+            wd.WeiboUtils.post_stem(post, store)
+        stem_us = (time.perf_counter() - start) / len(new_posts) * 1e6
+    finally:
+        store.close()
+        shutil.rmtree(save_dir, ignore_errors=True)
+    rows = [
+        {'case': 'clean_content', 'legacy_us': measure(legacy_clean_content, [(text,) for text in texts], args.repeat),
+         'current_us': measure(wd.WeiboUtils.clean_content, [(text,) for text in texts], args.repeat)},
+        {'case': 'post_filename', 'legacy_us': measure(legacy_names, [(post.time, post.content) for post in posts],
+                                                       args.repeat),
+         'current_us': stem_us},
+    ]
+    for row in rows:
+        row['speedup'] = round(row['legacy_us'] / row['current_us'], 2)
+        row['legacy_us'] = round(row['legacy_us'], 3)
+        row['current_us'] = round(row['current_us'], 3)
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print(f"语料:{len(texts)} 条，平均 {sum(map(len, texts)) / len(texts):.0f} 个字符，重复 {args.repeat} 次")
+        for row in rows:
+            print(f"{row['case']:<15} 旧 {row['legacy_us']:>8.3f} 微秒  新 {row['current_us']:>8.3f} 微秒  "
+                  f"{row['speedup']}x")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
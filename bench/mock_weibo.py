@@ -0,0 +1,267 @@
+"""本地模拟的微博接口和媒体 CDN，供 run_bench.py 做离线压测，不需要 Cookie
+
+提供 container/getIndex（资料和分页列表）、statuses/show 以及任意大小的媒体文件，
+媒体地址支持 HEAD 请求，可注入延迟、418/429 限流、传输中途断开和返回 200 的错误页。所有数据由 UID 和序号确定性生成。
+"""
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+CONTAINER_PREFIX = "107603"
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone(timedelta(hours=8)))
+
+class MockWeibo:
+    """模拟服务器的数据和故障注入配置，counters 记录各类请求数供基准统计"""
+    PAGE_SIZE = 10
+
+    def __init__(self, posts_per_uid=100, pics_per_post=3, media_size=200 * 1024, video_size=None,
+                 video_every=0, live_every=0, deleted_every=0, api_latency=0.0, media_latency=0.0,
+                 throttle_rate=0.0, disconnect_rate=0.0, corrupt_rate=0.0, expired_cookies=(), seed=1):
+        self.posts_per_uid = posts_per_uid
+        self.pics_per_post = pics_per_post
+        self.media_size = media_size
+        self.video_size = video_size if video_size else media_size * 8
+        self.video_every = video_every  # 每隔多少条带一个视频，0 表示没有视频
+        self.live_every = live_every  # 每隔多少张图是实况照片
+        self.deleted_every = deleted_every  # 每隔多少条在 statuses/show 中返回“微博不存在”
+        self.api_latency = api_latency  # 接口响应前的等待秒数
+        self.media_latency = media_latency  # 媒体首字节前的等待秒数
+        self.throttle_rate = throttle_rate  # 接口请求返回 418/429 的概率
+        self.disconnect_rate = disconnect_rate  # 媒体传输到一半断开连接的概率
+        self.corrupt_rate = corrupt_rate  # 媒体请求返回 200 但内容是 HTML 错误页的概率
+        self.expired_cookies = set(expired_cookies)  # 这些 Cookie 的接口请求返回 ok=-100（未登录）
+        self.cookie_requests = {}  # Cookie -> 接口请求数，检查凭据池的分配
+        self.counters = {'api': 0, 'throttled': 0, 'media': 0, 'media_bytes': 0, 'disconnects': 0, 'probes': 0,
+                         'corrupted': 0}
+        self.base_url = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.filler = bytes(range(256)) * 1024
+        self._server = None
+        self._thread = None
+
+    def start(self, host="127.0.0.1", port=0):
+        """在后台线程启动服务器，返回 base_url"""
+        handler = type("BoundHandler", (MockHandler,), {'mock': self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self.base_url = f"http://{host}:{self._server.server_address[1]}"
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-weibo", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.counters[key] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def chance(self, rate):
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    @staticmethod
+    def bid(uid, index):
+        """第 index 条（0 为最新）微博的 bid"""
+        return f"M{uid}x{index:06d}"
+
+    @staticmethod
+    def parse_bid(bid):
+        match = re.fullmatch(r"M(\d+)x(\d+)", bid or "")
+        return (match.group(1), int(match.group(2))) if match else (None, None)
+
+    def mblog(self, uid, index):
+        created = EPOCH - timedelta(minutes=index)
+        bid = self.bid(uid, index)
+        pics = []
+        for number in range(1, self.pics_per_post + 1):
+            pic = {'pid': f"{bid}_{number}", 'large': {'url': f"{self.base_url}/media/{bid}_{number}.jpg"}}
+            if self.live_every and number % self.live_every == 0:
+                pic['live_photo'] = f"{self.base_url}/media/{bid}_{number}.mov"
+            pics.append(pic)
+        mblog = {
+            'created_at': created.strftime('%a %b %d %H:%M:%S %z %Y'),
+            'id': f"{uid}{index:06d}",
+            'bid': bid,
+            'text': f"基准测试微博 {index} <br/>" + "正文内容" * 20 + ' <a href="/n/x">@某人</a>',
+            'user': {'id': int(uid), 'screen_name': f"bench{uid}", 'profile_image_url': f"{self.base_url}/avatar"},
+            'pics': pics,
+            'reposts_count': index, 'comments_count': index, 'attitudes_count': index,
+        }
+        if self.video_every and index % self.video_every == 0:
+            mblog['page_info'] = {'type': 'video', 'media_info': {
+                'stream_url': f"{self.base_url}/media/{bid}.mp4",
+                'stream_url_hd': f"{self.base_url}/media/{bid}_hd.mp4",
+                'mp4_720p_mp4': f"{self.base_url}/media/{bid}_720p.mp4",
+                'mp4_sd_url': f"{self.base_url}/media/{bid}_sd.mp4",
+            }}
+        return mblog
+
+    def profile(self, uid):
+        return {'ok': 1, 'data': {
+            'userInfo': {'id': int(uid), 'screen_name': f"bench{uid}"},
+            'tabsInfo': {'tabs': [
+                {'tab_type': 'profile', 'containerid': f"230283{uid}", 'title': '主页'},
+                {'tab_type': 'weibo', 'containerid': f"{CONTAINER_PREFIX}{uid}", 'title': '微博'},
+            ]},
+        }}
+
+    def page(self, uid, page):
+        start = (page - 1) * self.PAGE_SIZE
+        end = min(start + self.PAGE_SIZE, self.posts_per_uid)
+        cards = [{'card_type': 9, 'itemid': self.bid(uid, index), 'mblog': self.mblog(uid, index)}
+                 for index in range(start, end)]
+        return {'ok': 1 if cards else 0, 'data': {'cards': cards, 'cardlistInfo': {'page': page + 1}}}
+
+    def show(self, bid):
+        uid, index = self.parse_bid(bid)
+        if uid is None or index >= self.posts_per_uid or \
+                (self.deleted_every and index % self.deleted_every == self.deleted_every - 1):
+            return {'ok': 0, 'errno': "20101", 'msg': "该微博不存在"}
+        return {'ok': 1, 'data': self.mblog(uid, index)}
+
+    def media_size_of(self, name):
+        return self.video_size if name.endswith((".mp4", ".mov")) else self.media_size
+
+    def media_chunk(self, name, total, position, limit):
+        """文件中从 position 开始最多 limit 字节的内容，按绝对位置生成，续传时拼出的文件与一次下完的相同
+
+        文件头是真实的 JPEG/MP4 特征字节加上名字（保证不同文件内容不同），图片以 JPEG 结束标记收尾，能通过下载后校验
+        """
+        if name.endswith((".mp4", ".mov")):
+            prefix, trailer = b"\x00\x00\x00\x18ftypmp42" + name.encode("utf-8"), b""
+        else:
+            prefix, trailer = b"\xff\xd8\xff\xe0" + name.encode("utf-8"), b"\xff\xd9"
+        tail_start = total - len(trailer)
+        if position >= tail_start:
+            return trailer[position - tail_start:][:limit]
+        chunk = prefix[position:] if position < len(prefix) else \
+            self.filler[(position - len(prefix)) % len(self.filler):]
+        return chunk[:min(limit, tail_start - position)]
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 保持长连接，与真实 CDN 一样可复用
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path.startswith("/media/"):
+            self._send_media(parsed.path[len("/media/"):])
+            return
+        mock = self.mock
+        mock.count('api')
+        cookie = self.headers.get("Cookie", "")
+        with mock._lock:
+            mock.cookie_requests[cookie] = mock.cookie_requests.get(cookie, 0) + 1
+        if mock.api_latency:
+            time.sleep(mock.api_latency)
+        if cookie in mock.expired_cookies:
+            self._send_json({'ok': -100, 'url': "https://passport.weibo.cn/signin/welcome"})
+            return
+        if mock.chance(mock.throttle_rate):
+            mock.count('throttled')
+            self._send_json({'ok': 0, 'msg': "请求过于频繁"}, status=self._random_throttle_status())
+            return
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        if parsed.path == "/api/container/getIndex":
+            if query.get('type') == 'uid':
+                self._send_json(mock.profile(query.get('value', '0')))
+                return
+            containerid = query.get('containerid', '')
+            uid = containerid[len(CONTAINER_PREFIX):] if containerid.startswith(CONTAINER_PREFIX) else '0'
+            self._send_json(mock.page(uid, int(query.get('page', 1))))
+        elif parsed.path == "/statuses/show":
+            self._send_json(mock.show(query.get('id')))
+        else:
+            self._send_json({'ok': 0, 'msg': "not found"}, status=404)
+
+    def do_HEAD(self):
+        parsed = urlparse(self.path)
+        if not parsed.path.startswith("/media/"):
+            self.send_response(405)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        name = parsed.path[len("/media/"):]
+        self.mock.count('probes')
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4" if name.endswith((".mp4", ".mov")) else "image/jpeg")
+        self.send_header("Content-Length", str(self.mock.media_size_of(name)))
+        self.end_headers()
+
+    def _random_throttle_status(self):
+        return 418 if self.mock.chance(0.5) else 429
+
+    def _send_media(self, name):
+        mock = self.mock
+        mock.count('media')
+        if mock.media_latency:
+            time.sleep(mock.media_latency)
+        if mock.chance(mock.corrupt_rate):
+            mock.count('corrupted')
+            body = b"<html><body>403 Forbidden</body></html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        total = mock.media_size_of(name)
+        offset = 0
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            offset = int(match.group(1))
+            if offset >= total:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{total}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {offset}-{total - 1}/{total}")
+        else:
+            self.send_response(200)
+        length = total - offset
+        self.send_header("Content-Type", "video/mp4" if name.endswith((".mp4", ".mov")) else "image/jpeg")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        stop_at = length // 2 if mock.chance(mock.disconnect_rate) else length
+        sent = 0
+        while sent < length:
+            if sent >= stop_at:
+                mock.count('disconnects')
+                self.close_connection = True
+                return
+            chunk = mock.media_chunk(name, total, offset + sent, stop_at - sent)
+            try:
+                self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+                return
+            sent += len(chunk)
+            mock.count('media_bytes', len(chunk))
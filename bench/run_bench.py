@@ -0,0 +1,177 @@
+"""离线性能基准：在本地模拟服务器上运行抓取、失败重试和媒体下载，报告吞吐和资源占用
+
+每个场景在独立子进程中运行，峰值 RSS 互不影响。示例:
+    python bench/run_bench.py
+    python bench/run_bench.py --posts 500 --throttle-rate 0.02 --disconnect-rate 0.05 --json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import weibo_downloader as wd  # noqa: E402
+from mock_weibo import MockWeibo  # noqa: E402
+
+SCENARIOS = ("crawl", "retry", "download")
+BENCH_UID_BASE = 100000
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="基于本地模拟服务器的微博下载性能基准")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="逗号分隔，可选 crawl,retry,download")
+    parser.add_argument("--uids", type=int, default=2, help="模拟账号数")
+    parser.add_argument("--posts", type=int, default=200, help="每个账号的微博数")
+    parser.add_argument("--pics", type=int, default=3, help="每条微博的图片数")
+    parser.add_argument("--media-kb", type=int, default=200, help="每张图片的大小（KB）")
+    parser.add_argument("--video-every", type=int, default=10, help="每隔多少条带视频，0 表示不带")
+    parser.add_argument("--live-every", type=int, default=3, help="每隔多少张图是实况照片，0 表示没有")
+    parser.add_argument("--deleted-every", type=int, default=20, help="重试场景中每隔多少条是已删除微博")
+    parser.add_argument("--api-latency", type=float, default=0.005, help="接口延迟（秒）")
+    parser.add_argument("--media-latency", type=float, default=0.002, help="媒体首字节延迟（秒）")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="接口返回 418/429 的概率")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="媒体传输中途断开的概率")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="媒体返回 200 但内容是错误页的概率")
+    parser.add_argument("--verify-workers", type=int, default=0, help="下载后校验文件的进程数，0 表示不校验")
+    parser.add_argument("--api-rate", type=float, default=200.0, help="接口限速（次/秒）")
+    parser.add_argument("--post-workers", type=int, default=4)
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--per-host-limit", type=int, default=8)
+    parser.add_argument("--retry-workers", type=int, default=8)
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果，便于和历史结果比较")
+    return parser
+
+def prepare(args, base_url):
+    """子进程初始化：连接池、接口地址和日志都指向模拟服务器"""
+    logging.basicConfig(level=logging.CRITICAL)
+    wd.configure_http_pools(api_pool_size=args.uids + 1, cdn_pool_size=args.per_host_limit, cdn_hosts=2)
+    wd.WeiboClient.API_BASE = base_url
+    if args.verify_workers:
+        wd.configure_post_processor(wd.MediaPostProcessor(args.verify_workers))
+    limiter = wd.AdaptiveRateLimiter(args.api_rate, max_rate=args.api_rate, backoff_base=0.05, backoff_cap=1.0)
+    downloader = wd.MediaDownloader(args.download_workers, args.per_host_limit)
+    return limiter, downloader
+
+def uids(args):
+    return [str(BENCH_UID_BASE + number) for number in range(args.uids)]
+
+def run_crawl(args, base_url, work_dir):
+    limiter, downloader = prepare(args, base_url)
+    posts = failed = 0
+    for uid in uids(args):
+        save_dir = os.path.join(work_dir, f"bench{uid}_{uid}")
+        os.makedirs(save_dir)
+        crawler = wd.WeiboCrawler(uid, save_dir, 'url', "bench",
+                                  downloader=downloader, post_workers=args.post_workers, api_limiter=limiter)
+        stats = crawler.crawl() or {}
+        posts += stats.get('success', 0)
+        failed += stats.get('failed', 0)
+    downloader.shutdown()
+    return {'posts': posts, 'failed': failed}
+
+def run_retry(args, base_url, work_dir):
+    limiter, downloader = prepare(args, base_url)
+    for uid in uids(args):
+        save_dir = os.path.join(work_dir, f"bench{uid}_{uid}")
+        os.makedirs(save_dir)
+        store = wd.StateStore(save_dir)
+        store.commit_every = 1000
+        for index in range(args.posts):
+            store.mark_failed(f"https://weibo.com/{uid}/{MockWeibo.bid(uid, index)}")
+        store.close()
+    config = wd.Config(uid_list=uids(args), cookie="bench", interval=0, base_dir=work_dir, interactive=False,
+                       dedup_media=False, retry_workers=args.retry_workers)
+    stats = wd.RetryEngine(config, downloader, limiter).run()
+    downloader.shutdown()
+    return {'posts': stats['saved'] + stats['gone'], 'failed': stats['failed'] + stats['deferred']}
+
+def run_download(args, base_url, work_dir):
+    _, downloader = prepare(args, base_url)
+    tasks = [(f"{base_url}/media/D{number}.jpg", os.path.join(work_dir, f"D{number}.jpg"))
+             for number in range(args.posts * args.pics)]
+    results = downloader.download_each(tasks)
+    downloader.shutdown()
+    return {'posts': sum(results), 'failed': len(results) - sum(results)}
+
+def scenario_worker(name, args, base_url, result_queue):
+    """在子进程中运行一个场景，把耗时、结果和峰值 RSS 放回父进程"""
+    work_dir = tempfile.mkdtemp(prefix=f"weibo-bench-{name}-")
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr):  # 进度输出不混入 --json 结果
+            result = globals()[f"run_{name}"](args, base_url, work_dir)
+        if wd.POST_PROCESSOR:
+            wd.POST_PROCESSOR.close()
+        result['seconds'] = time.perf_counter() - start
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux 上单位为 KB
+        result_queue.put(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_scenario(name, args, mock):
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    before = mock.snapshot()
+    process = context.Process(target=scenario_worker, args=(name, args, mock.base_url, result_queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"场景 {name} 运行失败，退出码 {process.exitcode}")
+    result = result_queue.get()
+    after = mock.snapshot()
+    delta = {key: after[key] - before[key] for key in after}
+    seconds = max(result['seconds'], 1e-9)
+    posts = result['posts']
+    return {
+        'scenario': name,
+        'posts': posts,
+        'failed': result['failed'],
+        'seconds': round(seconds, 3),
+        'posts_per_s': round(posts / seconds, 2),
+        'mb_per_s': round(delta['media_bytes'] / seconds / (1024 * 1024), 2),
+        'api_calls_per_post': round(delta['api'] / posts, 3) if posts else None,
+        'peak_rss_mb': round(result['peak_rss_mb'], 1),
+        'throttled': delta['throttled'],
+        'disconnects': delta['disconnects'],
+    }
+
+def print_table(rows):
+    columns = ('scenario', 'posts', 'failed', 'seconds', 'posts_per_s', 'mb_per_s', 'api_calls_per_post',
+               'peak_rss_mb', 'throttled', 'disconnects')
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"未知场景:{','.join(unknown)}", file=sys.stderr)
+        return 2
+    mock = MockWeibo(posts_per_uid=args.posts, pics_per_post=args.pics, media_size=args.media_kb * 1024,
+                     video_every=args.video_every, live_every=args.live_every, deleted_every=args.deleted_every,
+                     api_latency=args.api_latency, media_latency=args.media_latency,
+                     throttle_rate=args.throttle_rate, disconnect_rate=args.disconnect_rate,
+                     corrupt_rate=args.corrupt_rate)
+    mock.start()
+    try:
+        rows = [run_scenario(name, args, mock) for name in names]
+    finally:
+        mock.stop()
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print_table(rows)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
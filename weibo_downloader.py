@@ -1,37 +1,411 @@
 import os
 import re
 import time
+import contextvars
 import json
+import csv
+import hashlib
+import functools
+import math
+import shutil
+import sqlite3
+import subprocess
+import multiprocessing
+import random
 import requests
+import sys
+import argparse
 from datetime import datetime
 import logging
-from urllib.parse import urlparse
+import logging.handlers
+import atexit
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse, parse_qs
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
 
 # 基础配置
-SESSION = requests.Session()
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 媒体下载的默认块大小
+DEFAULT_BASE_DIR = "C:\\Base1\\weibo" if os.name == 'nt' else os.path.expanduser("~/weibo")
+COOKIE_ENV = "WEIBO_COOKIE"  # 非交互运行时从该环境变量读取 Cookie
+NAME_MAX_BYTES = 255  # ext4 等文件系统单个文件名的字节上限，UTF-8 下一个汉字占 3 字节
+NAME_RESERVE_BYTES = 40  # 给扩展名、.part / .tmp 后缀和防重名的 -bid 留出的字节
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0"
+
+class CountingAdapter(HTTPAdapter):
+    """统计请求数和新建连接数的适配器，两者之差就是复用了已有连接的请求数"""
+    def __init__(self, *args, **kwargs):
+        self.request_count = 0
+        self.new_connections = 0
+        self._count_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _record(self, attr):
+        with self._count_lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def _counting_pool(self, pool_cls):
+        adapter = self
+
+        class CountingPool(pool_cls):
+            def _new_conn(self):
+                adapter._record('new_connections')
+                return super()._new_conn()
+
+        return CountingPool
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': self._counting_pool(HTTPConnectionPool),
+            'https': self._counting_pool(HTTPSConnectionPool),
+        }
+
+    def send(self, request, **kwargs):
+        self._record('request_count')
+        return super().send(request, **kwargs)
+
+class Http2Response:
+    """把 httpx 响应包装成本程序用到的 requests.Response 接口"""
+    def __init__(self, response, httpx):
+        self._response = response
+        self._httpx = httpx
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)  # 跟随重定向后的最终地址，用于识别跳转登录页
+
+    @property
+    def text(self):
+        return self._response.text
+
+    @property
+    def content(self):
+        return self._response.content
+
+    def json(self):
+        return json.loads(self._response.content)
+
+    def iter_content(self, chunk_size):
+        try:
+            yield from self._response.iter_bytes(chunk_size)
+        except self._httpx.HTTPError as e:
+            raise requests.ConnectionError(str(e))
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Http2Session:
+    """基于 httpx 的 HTTP/2 会话，同一主机的并发请求复用一条连接"""
+    def __init__(self, pool_size, max_hosts, retries):
+        import httpx
+        import h2  # noqa: F401  仅用于确认已安装 HTTP/2 支持
+        self._httpx = httpx
+        limits = httpx.Limits(max_connections=pool_size * max_hosts, max_keepalive_connections=pool_size * max_hosts)
+        transport = httpx.HTTPTransport(http2=True, limits=limits, retries=retries)
+        self.client = httpx.Client(http2=True, transport=transport, follow_redirects=True)
+        self.headers = self.client.headers
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        return self._send("GET", url, headers, timeout, stream)
+
+    def head(self, url, headers=None, timeout=None):
+        return self._send("HEAD", url, headers, timeout, False)
+
+    def _send(self, method, url, headers, timeout, stream):
+        request = self.client.build_request(method, url, headers=headers, timeout=timeout)
+        with self._count_lock:
+            self.request_count += 1
+        try:
+            response = self.client.send(request, stream=stream)
+        except self._httpx.HTTPError as e:
+            raise requests.ConnectionError(str(e))
+        return Http2Response(response, self._httpx)
+
+class HttpPool:
+    """一类主机（接口或 CDN）共用的长连接会话，显式设置连接池大小和重试策略"""
+    def __init__(self, name, pool_size, max_hosts, retries, http2=False):
+        self.name = name
+        self.http2 = False
+        if http2:
+            try:
+                self.session = Http2Session(pool_size, max_hosts, retries.total)
+                self.http2 = True
+                return
+            except ImportError:
+                logging.warning(f"未安装 httpx[http2]，{name} 连接池改用 HTTP/1.1")
+        self.session = requests.Session()
+        self.adapter = CountingAdapter(pool_connections=max_hosts, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        if self.http2:
+            return self.session.head(url, **kwargs)
+        return self.session.head(url, allow_redirects=True, **kwargs)
+
+    def stats(self):
+        """请求总数、新建连接数和复用连接的请求数；HTTP/2 下无法统计连接数"""
+        if self.http2:
+            return {'requests': self.session.request_count, 'new_connections': None, 'reused': None}
+        requests_sent = self.adapter.request_count
+        new_connections = self.adapter.new_connections
+        return {'requests': requests_sent, 'new_connections': new_connections,
+                'reused': max(0, requests_sent - new_connections)}
+
+def build_api_pool(name, pool_size, http2=False):
+    """新建一个接口连接池；凭据池中每个 Cookie 各用一个，服务器下发的 Cookie 不会串到别的账号"""
+    # 接口的 418/429/5xx 由 WeiboClient 自适应退避处理，适配器只重试连接失败
+    api_retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.5)
+    pool = HttpPool(name, pool_size, 2, api_retries, http2)
+    pool.session.headers.update({'User-Agent': USER_AGENT})
+    return pool
+
+def configure_http_pools(api_pool_size=4, cdn_pool_size=4, cdn_hosts=16, http2=False):
+    """按并发数重建接口和 CDN 连接池，需在开始抓取前调用"""
+    global API_POOL, CDN_POOL
+    cdn_retries = Retry(total=3, connect=3, read=2, status=3, backoff_factor=0.5,
+                        status_forcelist=(500, 502, 503, 504), allowed_methods=("GET", "HEAD"),
+                        raise_on_status=False)
+    API_POOL = build_api_pool("接口", api_pool_size, http2)
+    CDN_POOL = HttpPool("CDN", cdn_pool_size, cdn_hosts, cdn_retries, http2)
+    CDN_POOL.session.headers.update({'User-Agent': USER_AGENT, 'Referer': 'https://weibo.com/'})
+
+API_POOL = None  # m.weibo.cn 接口连接池，请求需带 Cookie
+CDN_POOL = None  # sinaimg / 视频 CDN 连接池，不带 Cookie
+configure_http_pools()
+
+class Metrics:
+    """进程内的计数器和分阶段耗时，可另外写 JSON Lines 事件日志和 Prometheus 文本格式"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (名称, 标签) -> 累计值
+        self._timings = {}  # (名称, 标签) -> [次数, 总秒数, 最大秒数]
+        self._events = None
+        self._server = None
+        self.prometheus_file = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                self._timings[key] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def event(self, event_name, **fields):
+        """写一行 JSON 事件，未配置事件文件时什么都不做"""
+        if self._events is None:
+            return
+        line = json.dumps({'ts': round(time.time(), 3), 'event': event_name, **fields}, ensure_ascii=False)
+        with self._lock:
+            if self._events:
+                self._events.write(line + "\n")
+
+    def total(self, name, **match):
+        """名称为 name 且标签包含 match 的累计值；耗时类指标返回总秒数"""
+        expected = set(self._key(name, match)[1])
+        with self._lock:
+            values = [value for (key, labels), value in self._counters.items()
+                      if key == name and expected <= set(labels)]
+            values += [timing[1] for (key, labels), timing in self._timings.items()
+                       if key == name and expected <= set(labels)]
+        return sum(values)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            timings = [{'name': name, 'labels': dict(labels), 'count': count, 'sum': round(total, 6),
+                        'max': round(longest, 6)}
+                       for (name, labels), (count, total, longest) in sorted(self._timings.items())]
+        return {'counters': counters, 'timings': timings}
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                   for key, value in labels]
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+    def prometheus_text(self):
+        """Prometheus 文本格式：计数器原样输出，耗时输出为 summary 的 _count / _sum"""
+        lines = []
+        declared = set()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted((key, list(value)) for key, value in self._timings.items())
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            value = value if isinstance(value, int) else round(value, 6)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), (count, total, _) in timings:
+            if name not in declared:
+                lines.append(f"# TYPE {name} summary")
+                declared.add(name)
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        """原子地重写 Prometheus 文本文件（供 node_exporter textfile 采集），未配置时跳过"""
+        if not self.prometheus_file:
+            return
+        tmp_path = self.prometheus_file + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, self.prometheus_file)
+
+    def serve_prometheus(self, port, host="127.0.0.1"):
+        """在后台线程提供 http://host:port/metrics"""
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200 if self.path in ("/", "/metrics") else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+
+    def configure(self, events_file=None, prometheus_file=None, prometheus_port=None):
+        if events_file:
+            self._events = open(events_file, 'a', encoding='utf-8', buffering=1)
+        self.prometheus_file = prometheus_file
+        if prometheus_port:
+            self.serve_prometheus(prometheus_port)
+
+    def close(self):
+        """写入汇总事件和最终的 Prometheus 文件，关闭事件日志和 HTTP 端点"""
+        self.event('summary', **self.snapshot())
+        self.write_prometheus()
+        with self._lock:
+            events, self._events = self._events, None
+        if events:
+            events.close()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+METRICS = Metrics()  # 全进程共享，未配置输出时只在内存中累计
 
 class Config:
-    def __init__(self, uid_list=None):
-        """初始化 Config 类，设置基本配置"""
-        self.COOKIE = self.get_cookie()
-        self.uid_list = uid_list if uid_list else self.get_uid_list()
-        self.uid = None  # 当前处理的 UID
-        self.download_dir = None
-        self.username = None
-        self.interval = self.get_interval()
-        self.username_cache = {}  # 用于缓存用户名
-        self.saved_url_filename = None
-        self.unsaved_url_filename = None
-        self.date_log_filename = None
-        # 提示用户输入基目录
-        base_dir_input = input("请输入保存文件的基目录（默认 C:\\Base1\\weibo）:").strip()
-        self.base_dir = base_dir_input if base_dir_input else "C:\\Base1\\weibo"
+    def __init__(self, uid_list=None, download_workers=8, per_host_limit=4, post_workers=4,
+                 uid_workers=4, api_rate=None, api_max_rate=None, media_rate=20, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 dedup_media=True, stop_after_known=5, http2=False, profile_ttl=3 * 86400,
+                 retry_workers=8, retry_max_attempts=8, ingest_workers=8, ingest_batch_size=500, stream_json=False,
+                 metrics_file=None, prometheus_file=None, prometheus_port=None, log_level="INFO",
+                 include_media=None, exclude_media=None, image_size=None, max_video_resolution=None,
+                 max_video_mb=None, byte_budget_mb=None, since=None, until=None, cookie_strategy="least-loaded",
+                 verify_media=False, verify_decode=False, verify_workers=2, transcode_images=None, remux_live=False,
+                 text_files=True, post_manifest=False, cookie=None, cookies=None, interval=None, base_dir=None, interactive=True, method='incremental'):
+        """初始化 Config 类，设置基本配置；interactive=False 时缺省项不再询问，直接用默认值"""
+        self.interactive = interactive
+        self.COOKIE = cookie if cookie else self.get_cookie()
+        # 有多个 Cookie 时组成凭据池，COOKIE 为第一个，用于获取昵称等零散请求
+        self.cookies = cookies if cookies else [self.COOKIE]
+        if cookie_strategy not in CredentialPool.STRATEGIES:
+            raise ValueError(f"未知的 Cookie 调度方式:{cookie_strategy}，可选 {', '.join(CredentialPool.STRATEGIES)}")
+        self.cookie_strategy = cookie_strategy
+        self.uid_list = uid_list if uid_list is not None else self.get_uid_list()
+        self.interval = interval if interval is not None else self.get_interval()
+        self.download_workers = download_workers  # 媒体下载线程池大小
+        self.post_workers = post_workers  # 每个账号并发保存微博的线程数
+        self.uid_workers = uid_workers  # 同时抓取的账号数
+        # 所有账号共享的接口初始速率（次/秒），默认与原先每个请求间隔 interval 秒一致
+        self.api_rate = api_rate if api_rate else 1.0 / max(self.interval, 0.1)
+        # 接口正常时自适应提速的上限，默认不超过 interval / api_rate 设定的速率，需要更快时显式设置 api_max_rate
+        self.api_max_rate = max(api_max_rate, self.api_rate) if api_max_rate else self.api_rate
+        self.media_rate = media_rate  # 所有账号共享的 CDN 下载限速（个文件/秒）
+        self.chunk_size = chunk_size  # 媒体下载块大小（字节）
+        self.dedup_media = dedup_media  # 是否通过 base_dir/.media_store 跨微博去重媒体文件
+        self.stop_after_known = stop_after_known  # 增量模式下连续遇到多少条已保存微博后停止
+        self.http2 = http2  # 安装了 httpx[http2] 时使用 HTTP/2
+        self.stream_json = stream_json  # 安装了 ijson 时流式解析微博列表；响应已整个读入内存，比 json.loads 更费 CPU，默认关闭
+        self.metrics_file = metrics_file  # 每次请求、每个文件的 JSON Lines 事件日志
+        self.prometheus_file = prometheus_file  # Prometheus 文本格式指标文件
+        self.prometheus_port = prometheus_port  # 提供 /metrics 的本地端口
+        self.log_level = log_level.upper()  # DEBUG 时额外记录每个请求的 URL 和响应片段
+        self.method = method  # 非交互 crawl 子命令默认的停止/去重方式
+        self.retry_workers = retry_workers  # 重试失败微博时的并发线程数
+        self.retry_max_attempts = retry_max_attempts  # 单条微博累计失败多少次后不再自动重试
+        self.ingest_workers = ingest_workers  # 按 bid 批量导入时并发请求的线程数
+        self.ingest_batch_size = ingest_batch_size  # 批量导入每批读取的行数，每批结束报告一次吞吐
+        self.per_host_limit = per_host_limit  # 每个 CDN 主机的最大并发连接数
+        # 下载前的媒体筛选，参数不合法时在这里抛出 ValueError；没有任何筛选项时为 None
+        filter_options = dict(include=include_media, exclude=exclude_media, image_size=image_size,
+                              max_video_resolution=max_video_resolution, max_video_mb=max_video_mb,
+                              byte_budget_mb=byte_budget_mb, since=since, until=until)
+        self.media_filter = MediaFilter(**filter_options) if any(filter_options.values()) else None
+        if transcode_images and transcode_images not in MediaPostProcessor.IMAGE_FORMATS:
+            raise ValueError(f"不支持的图片格式:{transcode_images}，可选 {', '.join(MediaPostProcessor.IMAGE_FORMATS)}")
+        self.verify_media = verify_media  # 下载后在进程池中校验文件，损坏的删除后重新下载；每条微博多一次进程间往返，默认关闭
+        self.verify_decode = verify_decode  # 校验时用 Pillow 完整解码图片，更准确也更耗 CPU
+        self.verify_workers = verify_workers  # 校验和转码进程池各自的进程数
+        self.transcode_images = transcode_images  # 把 JPEG 转成 webp / avif 并替换原文件，需要 Pillow
+        self.remux_live = remux_live  # 把实况照片的 mov 无损转封装为 mp4，需要 ffmpeg
+        self.text_files = text_files  # 每条微博写一个正文 txt；关闭后可用 export --format txt 从清单补写
+        self.post_manifest = post_manifest  # 把每条微博的正文、链接、时间和媒体文件批量写入账号的 posts.jsonl
+        self.base_dir = base_dir if base_dir else self.get_base_dir()
         if not os.path.exists(self.base_dir):
             os.makedirs(self.base_dir)
+        # 用户资料磁盘缓存，重复运行时跳过资料接口请求
+        self.profile_cache = ProfileCache(os.path.join(self.base_dir, ProfileCache.FILE_NAME), profile_ttl)
+        # UID 到账号文件夹的索引，抓取、重试共用同一个文件夹
+        self.account_dirs = AccountDirIndex(self.base_dir)
 
     def get_cookie(self):
         """获取并验证微博 Cookie"""
         cookie_length = 100
+        if not self.interactive:
+            raise ValueError(f"未提供 Cookie，请设置环境变量 {COOKIE_ENV} 或在配置中指定 cookie_file")
         while True:
             cookie = input("请输入微博 Cookie（必填）:").strip()
             if len(cookie) > cookie_length:
@@ -42,6 +416,8 @@ class Config:
     def get_uid_list(self):
         """获取 UID 列表，支持用户输入或使用默认值"""
         default_uid = ["2668367923", "5491928243", "2273396007"]
+        if not self.interactive:
+            raise ValueError("未提供 UID，请用 --uids 或在配置中指定 uids")
         result = ",".join(default_uid)
         print(f"回车默认下载 UID 为: {result}")
         uid_input = input("请输入用户 UID,多个 UID 用逗号分隔:").strip()
@@ -51,461 +427,2712 @@ class Config:
             uid_list = default_uid
         return uid_list
 
-    def get_username(self, uid):
-        """通过微博 API 获取用户昵称，支持缓存"""
-        if uid in self.username_cache:
-            return self.username_cache[uid]
-        url = f"https://m.weibo.cn/api/container/getIndex?type=uid&value={uid}"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0",
-            "Cookie": self.COOKIE
-        }
+    def get_interval(self):
+        """获取用户指定的下载间隔"""
+        if not self.interactive:
+            return 3
+        user_interval = input("请输入 float 类型下载间隔（秒，默认 3）:").strip()
+        if not user_interval:
+            return 3
+        else:
+            try:
+                float_user_interval = float(user_interval)
+                print("您现在输入的间隔是:", float_user_interval, "秒")
+                return float_user_interval
+            except ValueError:
+                print("输入无效，默认使用 3 秒")
+                return 3
+
+    def get_base_dir(self):
+        """提示用户输入保存文件的基目录"""
+        if not self.interactive:
+            return DEFAULT_BASE_DIR
+        base_dir_input = input(f"请输入保存文件的基目录（默认 {DEFAULT_BASE_DIR}）:").strip()
+        return base_dir_input if base_dir_input else DEFAULT_BASE_DIR
+
+class FileManager:
+    """读取旧版 saved_urls.log / unsaved_urls.log / date.log，仅用于导入状态库"""
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+
+    @staticmethod
+    def iter_lines(file_path):
+        """逐行读取非空行，不把整个文件读进内存"""
+        if not os.path.exists(file_path):
+            return
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+class BloomFilter:
+    """位数组布隆过滤器：不在其中的键一定不在集合里，每个键约占 10 个比特"""
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1024)
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class RecentKeys:
+    """只记住最近加入的 maxlen 个键，内存不随账号微博总数增长"""
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self._keys = OrderedDict()
+
+    def add(self, key):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.maxlen:
+            self._keys.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+class StateStore:
+    """单个账号的下载状态库（SQLite），以微博 bid 为主键，取代三个平面日志文件"""
+    DB_NAME = "state.db"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS posts (
+            bid TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            status TEXT NOT NULL,
+            publish_time TEXT,
+            media TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_posts_status_time ON posts (status, publish_time);
+        CREATE TABLE IF NOT EXISTS media_files (
+            bid TEXT NOT NULL,
+            path TEXT NOT NULL,
+            url TEXT NOT NULL,
+            done INTEGER NOT NULL,
+            PRIMARY KEY (bid, path)
+        );
+        CREATE TABLE IF NOT EXISTS stems (
+            stem TEXT PRIMARY KEY,
+            bid TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS coverage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            mode TEXT NOT NULL,
+            first_page INTEGER NOT NULL,
+            last_page INTEGER NOT NULL,
+            newest_time TEXT,
+            oldest_time TEXT,
+            reached_end INTEGER NOT NULL,
+            finished_at REAL
+        );
+    """
+    IMPORT_BATCH = 5000
+    CACHE_KIB = 1024  # SQLite 堆内页缓存上限，主键索引改由 mmap 读取，内存不随库大小增长
+    MMAP_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.db_path = os.path.join(save_dir, self.DB_NAME)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA cache_size=-{self.CACHE_KIB}")
+        self._conn.execute(f"PRAGMA mmap_size={self.MMAP_BYTES}")
+        self._conn.executescript(self.SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(posts)")}
+        if 'next_retry_at' not in columns:  # 旧版状态库没有重试时间列
+            self._conn.execute("ALTER TABLE posts ADD COLUMN next_retry_at REAL")
+        self.commit_every = 1  # 累计多少次写入提交一次事务，批量重试时调大
+        self._pending = 0
+        self.import_legacy_logs()
+        self.backfill_stems()
+        self._saved_filter = self._build_saved_filter()
+        self.post_manifest = PostManifest(save_dir) if POST_MANIFEST else None
+
+    def _build_saved_filter(self):
+        """用游标逐行读取已保存的 bid 建立布隆过滤器，新微博不必查库即可判定未保存"""
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM posts WHERE status = 'saved'").fetchone()[0]
+            bloom = BloomFilter(count * 2)  # 留出本次运行新增的余量，超出后只是误判率上升
+            for (bid,) in self._conn.execute("SELECT bid FROM posts WHERE status = 'saved'"):
+                bloom.add(bid)
+        return bloom
+
+    def _commit_locked(self, force=False):
+        if not force:
+            self._pending += 1
+        if force or self._pending >= self.commit_every:
+            with METRICS.timer("weibo_disk_write_seconds", target="state"):
+                self._conn.commit()
+            self._pending = 0
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            self._commit_locked()
+            return cursor
+
+    def flush(self):
+        """提交尚未提交的批量写入"""
+        with self._lock:
+            self._commit_locked(force=True)
+
+    def _fetchone(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def get_meta(self, key):
+        row = self._fetchone("SELECT value FROM meta WHERE key = ?", (key,))
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self._execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _import_urls(self, file_path, status):
+        batch = []
+        sql = "INSERT OR IGNORE INTO posts (bid, url, status, updated_at) VALUES (?, ?, ?, ?)"
+        now = time.time()
+        count = 0
+        for url in FileManager.iter_lines(file_path):
+            bid = extract_bid_from_url(url)
+            if not bid:
+                continue
+            batch.append((bid, url, status, now))
+            if len(batch) >= self.IMPORT_BATCH:
+                self._conn.executemany(sql, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self._conn.executemany(sql, batch)
+            count += len(batch)
+        return count
+
+    def import_legacy_logs(self):
+        """一次性导入旧版日志文件，导入后以 meta 标记，不再重复读取"""
+        if self.get_meta("legacy_imported"):
+            return
+        saved_file = os.path.join(self.save_dir, "saved_urls.log")
+        unsaved_file = os.path.join(self.save_dir, "unsaved_urls.log")
+        date_file = os.path.join(self.save_dir, "date.log")
+        with self._lock, self._conn:
+            saved = self._import_urls(saved_file, 'saved')  # 先导入已保存，失败记录不会覆盖它
+            unsaved = self._import_urls(unsaved_file, 'failed')
+            # date.log 只有时间没有 bid，只保留最新的一条作为截止时间
+            newest = max(FileManager.iter_lines(date_file), default=None)
+            if newest:
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                   ("legacy_newest_publish_time", newest))
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                               ("legacy_imported", str(int(time.time()))))
+        if saved or unsaved or newest:
+            logging.info(f"已从旧日志导入 {saved} 条已保存、{unsaved} 条失败记录")
+
+    def backfill_stems(self):
+        """一次性按媒体清单登记旧版已用的目录名和视频文件名，新微博不会再沿用同名微博的目录"""
+        if self.get_meta("stems_backfilled"):
+            return
+        owners = {}
+        with self._lock, self._conn:
+            for bid, path in self._conn.execute("SELECT bid, path FROM media_files"):
+                head, _, rest = path.partition(os.sep)
+                owners.setdefault(os.path.splitext(rest)[0] if head == "plain_videos" else head, bid)
+            self._conn.executemany("INSERT OR IGNORE INTO stems (stem, bid) VALUES (?, ?)", owners.items())
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                               ("stems_backfilled", str(int(time.time()))))
+
+    def claim_stem(self, stem, bid):
+        """登记文件名主干的归属并返回所有者 bid，已被另一条微博占用时返回那条微博的 bid，跨进程、跨运行有效
+
+        不单独提交，随这条微博随后的状态写入一起提交
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT bid FROM stems WHERE stem = ?", (stem,)).fetchone()
+            if row:
+                return row[0]
+            if self._conn.execute("INSERT OR IGNORE INTO stems (stem, bid) VALUES (?, ?)", (stem, bid)).rowcount:
+                return bid
+            return self._conn.execute("SELECT bid FROM stems WHERE stem = ?", (stem,)).fetchone()[0]
+
+    def is_saved(self, bid):
+        if bid not in self._saved_filter:
+            return False
+        return self._fetchone("SELECT 1 FROM posts WHERE bid = ? AND status = 'saved'", (bid,)) is not None
+
+    def newest_publish_time(self):
+        """已保存微博中最新的发布时间，走 (status, publish_time) 索引"""
+        row = self._fetchone("SELECT MAX(publish_time) FROM posts WHERE status = 'saved'")
+        newest = row[0] if row else None
+        legacy = self.get_meta("legacy_newest_publish_time")
+        if legacy and (not newest or legacy > newest):
+            return legacy
+        return newest
+
+    def mark_saved(self, weibo):
+        with self._lock:
+            self._saved_filter.add(weibo.bid)
+        media = json.dumps({'pics': [pic.to_dict() for pic in weibo.pics], 'video': weibo.video}, ensure_ascii=False)
+        self._execute(
+            "INSERT INTO posts (bid, url, status, publish_time, media, updated_at) VALUES (?, ?, 'saved', ?, ?, ?) "
+            "ON CONFLICT(bid) DO UPDATE SET url = excluded.url, status = 'saved', "
+            "publish_time = excluded.publish_time, media = excluded.media, updated_at = excluded.updated_at",
+            (weibo.bid, weibo.url, weibo.publish_time, media, time.time()))
+        if self.post_manifest:
+            self.post_manifest.append(self._manifest_record(weibo))
+
+    def _manifest_record(self, weibo):
+        """元数据清单中的一行，路径相对账号文件夹，bytes 为 None 表示文件未下载完成"""
+        media = []
+        for path, done in sorted((self.file_manifest(weibo.bid) or {}).items()):
+            try:
+                size = os.path.getsize(path) if done else None
+            except OSError:
+                size = None  # 已被转码替换
+            media.append({'path': os.path.relpath(path, self.save_dir), 'done': done, 'bytes': size})
+        text_path = os.path.relpath(weibo.text_path, self.save_dir) if weibo.text_path else None
+        return {'bid': weibo.bid, 'url': weibo.url, 'publish_time': weibo.publish_time, 'time': weibo.time,
+                'content': weibo.content, 'text_path': text_path, 'media': media, 'saved_at': round(time.time(), 3)}
+
+    def mark_failed(self, url, publish_time=None, retry_after=None):
+        """记录一次失败，已保存的微博不会被改回失败；retry_after 秒内不再参与重试"""
+        bid = extract_bid_from_url(url)
+        if not bid:
+            return
+        now = time.time()
+        next_retry_at = now + retry_after if retry_after else None
+        self._execute(
+            "INSERT INTO posts (bid, url, status, publish_time, attempts, updated_at, next_retry_at) "
+            "VALUES (?, ?, 'failed', ?, 1, ?, ?) "
+            "ON CONFLICT(bid) DO UPDATE SET attempts = attempts + 1, updated_at = excluded.updated_at, "
+            "next_retry_at = excluded.next_retry_at, "
+            "status = CASE WHEN status = 'saved' THEN status ELSE 'failed' END, "
+            "publish_time = COALESCE(posts.publish_time, excluded.publish_time)",
+            (bid, url, publish_time, now, next_retry_at))
+
+    def mark_gone(self, bid):
+        """微博已被删除，标记为 gone，以后不再重试"""
+        self._execute("UPDATE posts SET status = 'gone', next_retry_at = NULL, updated_at = ? "
+                      "WHERE bid = ? AND status != 'saved'", (time.time(), bid))
+
+    def record_files(self, bid, files):
+        """记录单条微博每个媒体文件 (url, path, 是否完成)"""
+        rows = [(bid, os.path.relpath(path, self.save_dir), url, int(bool(done))) for url, path, done in files]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO media_files (bid, path, url, done) VALUES (?, ?, ?, ?)", rows)
+            self._commit_locked()
+
+    def file_manifest(self, bid):
+        """单条微博的媒体清单 {规范化绝对路径: 是否完成}
+
+        从未见过的新微博返回空字典，文件一定不存在；状态库里有这条微博却没有清单（旧版导入）时返回 None，
+        调用方需回退到检查文件是否存在
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT path, done FROM media_files WHERE bid = ?", (bid,)).fetchall()
+            if not rows and self._conn.execute("SELECT 1 FROM posts WHERE bid = ?", (bid,)).fetchone():
+                return None
+        return {os.path.normpath(os.path.join(self.save_dir, path)): bool(done) for path, done in rows}
+
+    def done_files(self, batch_size=500):
+        """按主键分批返回清单中已完成的文件 [(bid, 绝对路径, url)]，大库也不会一次读入内存"""
+        last = ("", "")
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT bid, path, url FROM media_files WHERE done = 1 AND (bid, path) > (?, ?) "
+                    "ORDER BY bid, path LIMIT ?", last + (batch_size,)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][:2]
+            yield [(bid, os.path.join(self.save_dir, path), url) for bid, path, url in rows]
+
+    def requeue(self, bid, paths):
+        """文件已损坏：清单中改为未完成，微博改回失败并清零尝试次数，retry 时按清单只重新下载这些文件"""
+        rows = [(bid, os.path.relpath(path, self.save_dir)) for path in paths]
+        with self._lock:
+            self._conn.executemany("UPDATE media_files SET done = 0 WHERE bid = ? AND path = ?", rows)
+            self._conn.execute("UPDATE posts SET status = 'failed', attempts = 0, next_retry_at = NULL, "
+                               "updated_at = ? WHERE bid = ?", (time.time(), bid))
+            self._commit_locked()
+
+    def update_high_water(self):
+        """把最新已保存微博的 bid 和发布时间记为该账号的高水位"""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT bid, publish_time FROM posts WHERE status = 'saved' "
+                                     "AND publish_time IS NOT NULL ORDER BY publish_time DESC LIMIT 1").fetchone()
+            if row:
+                self._conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                       [("high_water_bid", row[0]), ("high_water_time", row[1])])
+
+    def high_water(self):
+        return self.get_meta("high_water_bid"), self.get_meta("high_water_time")
+
+    def record_coverage(self, mode, first_page, last_page, newest_time, oldest_time, reached_end):
+        """记录一次抓取完整检查过的页码范围"""
+        self._execute(
+            "INSERT INTO coverage (mode, first_page, last_page, newest_time, oldest_time, reached_end, finished_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (mode, first_page, last_page, newest_time, oldest_time, int(reached_end), time.time()))
+
+    def history_cursor(self):
+        """回溯游标：(从第一页连续覆盖到的页码, 覆盖到的最早发布时间, 是否已到时间线末尾)"""
+        page = self.get_meta("history_page")
+        return (int(page) if page else None, self.get_meta("history_oldest_time"),
+                self.get_meta("history_complete") == "1")
+
+    def advance_history(self, page, oldest_time, reached_end=False):
+        """与已覆盖历史相连的抓取推进回溯游标，只会往更深处推进"""
+        with self._lock, self._conn:
+            rows = dict(self._conn.execute(
+                "SELECT key, value FROM meta WHERE key IN ('history_page', 'history_oldest_time')").fetchall())
+            updates = []
+            if not rows.get('history_page') or page > int(rows['history_page']):
+                updates.append(("history_page", str(page)))
+            if oldest_time and (not rows.get('history_oldest_time') or oldest_time < rows['history_oldest_time']):
+                updates.append(("history_oldest_time", oldest_time))
+            if reached_end:
+                updates.append(("history_complete", "1"))
+            self._conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", updates)
+
+    def due_failed(self, max_attempts):
+        """已到重试时间且未超过最大尝试次数的失败微博 [(url, attempts)]，新发布的在前"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT url, attempts FROM posts WHERE status = 'failed' AND attempts < ? "
+                "AND (next_retry_at IS NULL OR next_retry_at <= ?) ORDER BY publish_time DESC",
+                (max_attempts, time.time())).fetchall()
+
+    def count(self, status):
+        return self._fetchone("SELECT COUNT(*) FROM posts WHERE status = ?", (status,))[0]
+
+    def close(self):
+        with self._lock:
+            self._commit_locked(force=True)
+            self._conn.close()
+        if self.post_manifest:
+            self.post_manifest.close()
+
+class PostManifest:
+    """单个账号的微博元数据清单 posts.jsonl，每条已保存的微博一行
+
+    先缓冲在内存里，攒够 BATCH_SIZE 条或距上次写入超过 FSYNC_INTERVAL 秒时一次追加，并按间隔 fsync，
+    网络存储上不再为每条微博打开、写入、关闭小文件。同一条微博重新保存时会追加新行，读取时以最后一行为准
+    """
+    FILE_NAME = "posts.jsonl"
+    BATCH_SIZE = 100
+    FSYNC_INTERVAL = 10
+
+    def __init__(self, save_dir):
+        self.path = os.path.join(save_dir, self.FILE_NAME)
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._file = None
+        self._synced_at = time.monotonic()
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.BATCH_SIZE or time.monotonic() - self._synced_at >= self.FSYNC_INTERVAL:
+                self._write_locked()
+
+    def _write_locked(self, sync=False):
+        if self._buffer:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            with METRICS.timer("weibo_disk_write_seconds", target="manifest"):
+                self._file.write("".join(self._buffer))
+                self._file.flush()
+            self._buffer.clear()
+        if self._file and (sync or time.monotonic() - self._synced_at >= self.FSYNC_INTERVAL):
+            os.fsync(self._file.fileno())
+            self._synced_at = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._write_locked(sync=True)
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    @classmethod
+    def records(cls, save_dir):
+        """读取清单 {bid: 最后一次保存的记录}，跳过异常退出时写了一半的行"""
+        records = {}
+        for line in FileManager.iter_lines(os.path.join(save_dir, cls.FILE_NAME)):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['bid']] = record
+        return records
+
+def configure_output(text_files=True, post_manifest=False):
+    """设置每条微博是否写正文文件、是否写入账号的元数据清单，在打开状态库之前调用"""
+    global TEXT_FILES, POST_MANIFEST
+    TEXT_FILES = text_files
+    POST_MANIFEST = post_manifest
+
+TEXT_FILES = True  # 由 configure_output 设置
+POST_MANIFEST = False
+
+class ProfileCache:
+    """UID 资料（昵称、containerid、tabs）的磁盘缓存，超过 ttl 秒重新请求"""
+    FILE_NAME = ".profile_cache.json"
+
+    def __init__(self, path, ttl=3 * 86400):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"资料缓存读取失败，将重新获取:{str(e)}")
+
+    def get(self, uid):
+        with self._lock:
+            entry = self._data.get(uid)
+        if entry and time.time() - entry.get('fetched_at', 0) < self.ttl:
+            return entry
+        return None
+
+    def put(self, uid, profile):
+        with self._lock:
+            self._data[uid] = dict(profile, fetched_at=time.time())
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+class AccountDirIndex:
+    """UID 到账号文件夹的持久索引，昵称变化后仍沿用第一次建立的文件夹"""
+    FILE_NAME = ".account_dirs.json"
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.path = os.path.join(base_dir, self.FILE_NAME)
+        self._lock = threading.Lock()
+        self._dirs = {}  # uid -> base_dir 下的文件夹名
+        self._scanned = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._dirs = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"账号文件夹索引读取失败，将重新扫描:{str(e)}")
+
+    @staticmethod
+    def uid_of(folder_name):
+        """文件夹名最后一个 "_" 之后的 UID，按整段精确匹配，不会把 UID 的子串当成匹配"""
+        _, sep, suffix = folder_name.rpartition('_')
+        return suffix if sep and suffix.isdigit() else None
+
+    def _scan_locked(self):
+        """扫描一次 base_dir 第一层，收录所有 "名称_UID" 文件夹，同一 UID 有多个时优先有状态库的"""
+        found = {}
+        with os.scandir(self.base_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_dir():
+                    continue
+                uid = self.uid_of(entry.name)
+                if uid is None:
+                    continue
+                has_state = os.path.exists(os.path.join(entry.path, StateStore.DB_NAME))
+                if uid not in found or (has_state and not found[uid][1]):
+                    found[uid] = (entry.name, has_state)
+        for uid, (name, _) in found.items():
+            self._dirs.setdefault(uid, name)
+        self._scanned = True
+
+    def _save_locked(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._dirs, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _lookup_locked(self, uid):
+        folder = self._dirs.get(uid)
+        if folder and os.path.isdir(os.path.join(self.base_dir, folder)):
+            return folder
+        if folder:
+            del self._dirs[uid]  # 文件夹已被移走，重新扫描或新建
+        if not self._scanned:
+            self._scan_locked()
+            folder = self._dirs.get(uid)
+            if folder:
+                self._save_locked()
+        return folder
+
+    def find(self, uid):
+        """返回 uid 已有的账号文件夹路径，没有时返回 None，不新建"""
+        with self._lock:
+            folder = self._lookup_locked(uid)
+        return os.path.join(self.base_dir, folder) if folder else None
+
+    def existing(self):
+        """索引中仍然存在的全部账号文件夹 {uid: 路径}"""
+        with self._lock:
+            if not self._scanned:
+                self._scan_locked()
+            return {uid: os.path.join(self.base_dir, folder) for uid, folder in self._dirs.items()
+                    if os.path.isdir(os.path.join(self.base_dir, folder))}
+
+    def resolve(self, uid, name_fn):
+        """返回 uid 的账号文件夹路径；索引和已有文件夹都没有时才调用 name_fn() 取昵称并新建"""
+        with self._lock:
+            folder = self._lookup_locked(uid)
+        if folder:
+            return os.path.join(self.base_dir, folder)
+        name = WeiboUtils.get_valid_filename(name_fn() or f"unknown_{uid}")
+        with self._lock:
+            # 取昵称期间其他线程可能已为同一 UID 建好文件夹
+            folder = self._dirs.setdefault(uid, f"{name}_{uid}")
+            path = os.path.join(self.base_dir, folder)
+            os.makedirs(path, exist_ok=True)
+            self._save_locked()
+        logging.info(f"账号 {uid} 使用文件夹: {path}")
+        return path
+
+class WeiboUtils:
+    """工具方法集合"""
+    CONTENT_LENGTH = 20  # 文件名中保留的正文字符数
+    # 一个正则依次识别 HTML 标签、空白和可用于文件名的字符（汉字、字母数字、_ 和 -），其余字符被跳过
+    CONTENT_TOKENS = re.compile(r'<[^>]+>|(\s+)|([\u4e00-\u9fa5a-zA-Z0-9_-]+)')
+    INVALID_FILENAME_CHARS = re.compile(r'[\\/*?:"<>|\n\r]')
+    MIN_DIR_NAME = 19  # 截短目录名时至少保留开头的发布时间 %Y-%m-%d-%H-%M-%S
+
+    @staticmethod
+    def clean_content(content, limit=CONTENT_LENGTH):
+        """去掉 HTML 标签和文件名中不能用的字符，连续空白合并为一个空格，返回前 limit 个字符
+
+        一遍扫描，攒够 limit 个字符即停止，不再处理整条微博的 HTML
+        """
+        parts = []
+        size = 0
+        space = False
+        for match in WeiboUtils.CONTENT_TOKENS.finditer(content):
+            if match.group(1):
+                space = True  # 空白之间被跳过的字符和标签不打断空白，与先删除再合并空白一致
+                continue
+            word = match.group(2)
+            if not word:
+                continue  # HTML 标签
+            if space:
+                parts.append(' ')
+                size += 1
+                space = False
+                if size >= limit:
+                    break
+            word = word[:limit - size]
+            parts.append(word)
+            size += len(word)
+            if size >= limit:
+                break
+        return ''.join(parts).rstrip()
+
+    @staticmethod
+    def truncate_utf8(name, max_bytes):
+        """按 UTF-8 字节数截短，不会截断半个字符"""
+        encoded = name.encode('utf-8')
+        if len(encoded) <= max_bytes:
+            return name
+        return encoded[:max_bytes].decode('utf-8', 'ignore')
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def get_valid_filename(name):
+        """去掉文件名中不能用的字符，并截短到文件系统允许的字节数，结果按输入缓存"""
+        name = WeiboUtils.INVALID_FILENAME_CHARS.sub('', name)
+        return WeiboUtils.truncate_utf8(name, NAME_MAX_BYTES - NAME_RESERVE_BYTES).rstrip()
+
+    @staticmethod
+    def post_stem(weibo, store=None):
+        """一条微博的目录名 / 文件名主干“发布时间-正文前缀”
+
+        传入 store 时归属记在状态库里：同一秒发布且正文前缀相同的另一条微博（包括之前运行或其他进程保存的）
+        已经用了这个名字时加上 -bid，两条微博的文件不会互相覆盖
+        """
+        stem = f"{weibo.time}-{WeiboUtils.get_valid_filename(weibo.content)}".rstrip()
+        if store and store.claim_stem(stem, weibo.bid) != weibo.bid:
+            return f"{stem}-{weibo.bid}"
+        return stem
+
+    _made_dirs = set()  # 本进程中已确认存在的固定目录
+
+    @staticmethod
+    def ensure_dir(path):
+        """创建 plain_txt 这类每条微博都会用到的目录，同一目录每个进程只调用一次 makedirs"""
+        if path not in WeiboUtils._made_dirs:
+            os.makedirs(path, exist_ok=True)
+            WeiboUtils._made_dirs.add(path)
+        return path
+
+    @staticmethod
+    def safe_mkdir(path):
+        """创建目录并返回实际路径；路径过长等原因失败时把目录名逐次减半，至少保留开头的发布时间，仍失败则抛出"""
+        base, name = os.path.split(path)
+        while True:
+            try:
+                os.makedirs(os.path.join(base, name), exist_ok=True)
+                return os.path.join(base, name)
+            except OSError:
+                if len(name) <= WeiboUtils.MIN_DIR_NAME:
+                    raise
+                name = name[:max(WeiboUtils.MIN_DIR_NAME, len(name) // 2)].rstrip()
+
+    @staticmethod
+    def _expected_size(response, offset):
+        """根据 Content-Range / Content-Length 计算完整文件大小，无法确定时返回 None"""
+        if response.status_code == 206:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+        if response.headers.get('Content-Encoding'):
+            return None  # 压缩传输时 Content-Length 不是文件大小
+        length = response.headers.get('Content-Length', '')
+        return int(length) if length.isdigit() else None
+
+    @staticmethod
+    def download_media(url, path, chunk_size=DOWNLOAD_CHUNK_SIZE, max_resumes=3, check_exists=True):
+        """下载到 .part 临时文件，中断后用 Range 续传，大小与 Content-Length 一致才改名为正式文件
+
+        调用方已确认文件不存在（如查过清单）时传 check_exists=False，省去一次文件系统查询
+        """
+        if check_exists and os.path.exists(path):
+            return True
+        progress = {'bytes': 0, 'write_seconds': 0.0, 'resumes': 0}
+        start = time.perf_counter()
+        done = WeiboUtils._download_part(url, path, chunk_size, max_resumes, progress)
+        WeiboUtils.record_download(url, path, done, progress, time.perf_counter() - start)
+        return done
+
+    @staticmethod
+    def record_download(url, path, done, progress, elapsed):
+        """记录一个媒体文件的下载耗时、字节数和续传次数，两种网络后端共用"""
+        kind = 'video' if path.endswith(('.mp4', '.mov')) else 'image'
+        METRICS.observe("weibo_media_download_seconds", elapsed, kind=kind, result='ok' if done else 'failed')
+        METRICS.inc("weibo_media_bytes_total", progress['bytes'], kind=kind)
+        METRICS.observe("weibo_disk_write_seconds", progress['write_seconds'], target="media")
+        if progress['resumes']:
+            METRICS.inc("weibo_media_resumes_total", progress['resumes'])
+        METRICS.event('media', url=url, kind=kind, ok=done, bytes=progress['bytes'], seconds=round(elapsed, 4),
+                      write_seconds=round(progress['write_seconds'], 4), resumes=progress['resumes'])
+
+    @staticmethod
+    def probe_size(url):
+        """用 HEAD 请求取得媒体文件大小，拿不到时返回 None"""
+        METRICS.inc("weibo_media_probes_total")
         try:
-            time.sleep(3)
-            response = requests.get(url, headers=headers, timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                username = data.get('data', {}).get('userInfo', {}).get('screen_name', f"用户_{uid}")
-                self.username_cache[uid] = username
-                return username
-            else:
-                print(f"API 请求失败，状态码: {response.status_code}")
+            with CDN_POOL.head(url, timeout=10) as response:
+                return WeiboUtils._expected_size(response, 0) if response.status_code == 200 else None
+        except Exception as e:
+            logging.debug(f"获取文件大小失败 {url}:{str(e)}")
+            return None
+
+    @staticmethod
+    def part_size(part_path):
+        """已下载的临时文件大小，不存在时为 0"""
+        try:
+            return os.path.getsize(part_path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _download_part(url, path, chunk_size, max_resumes, progress):
+        part_path = path + ".part"
+        try:
+            for attempt in range(max_resumes + 1):
+                if attempt:
+                    progress['resumes'] += 1
+                offset = WeiboUtils.part_size(part_path)
+                request_headers = {'Range': f"bytes={offset}-"} if offset else None
+                with CDN_POOL.get(url, headers=request_headers, stream=True, timeout=20) as response:
+                    if response.status_code == 416:
+                        # 服务器不接受该范围，说明临时文件已损坏，从头下载
+                        os.remove(part_path)
+                        continue
+                    if response.status_code not in (200, 206):
+                        return False
+                    expected = WeiboUtils._expected_size(response, offset)
+                    mode = 'ab' if response.status_code == 206 else 'wb'
+                    try:
+                        with open(part_path, mode) as f:
+                            for chunk in response.iter_content(chunk_size=chunk_size):
+                                write_start = time.perf_counter()
+                                f.write(chunk)
+                                progress['write_seconds'] += time.perf_counter() - write_start
+                                progress['bytes'] += len(chunk)
+                    except requests.RequestException as e:
+                        logging.warning(f"下载中断，准备续传 {url}:{str(e)}")
+                        continue
+                size = os.path.getsize(part_path)
+                if expected is None or size == expected:
+                    os.replace(part_path, path)
+                    return True
+                if size > expected:
+                    os.remove(part_path)
+                logging.warning(f"文件不完整 {url}:{size}/{expected} 字节，第 {attempt + 1} 次续传")
+            logging.error(f"下载失败 {url}:续传 {max_resumes} 次后仍不完整")
+        except Exception as e:
+            logging.error(f"下载失败 {url}:{str(e)}")
+        return False
+
+class MediaStore:
+    """按内容寻址的媒体库：同一张图片/视频只下载一次，其他微博目录中用硬链接引用"""
+    DIR_NAME = ".media_store"
+    FICLONE = 0x40049409  # Linux 上 btrfs/xfs 的 reflink ioctl
+
+    def __init__(self, base_dir):
+        self.root = os.path.join(base_dir, self.DIR_NAME)
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self.root, "index.db"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL)")
+        self._conn.commit()
+        self.hits = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def media_key(url):
+        """图片以 URL 中的微博图片 id 为键（非 large 尺寸再加上尺寸，缩略图不会顶替原图），视频以去掉签名参数后的路径哈希为键"""
+        parsed = urlparse(url)
+        livephoto = parse_qs(parsed.query).get('livephoto')
+        if livephoto:  # video.weibo.com/media/play?livephoto=<真实 mov 地址>
+            return MediaStore.media_key(livephoto[0])
+        name, ext = os.path.splitext(os.path.basename(parsed.path))
+        if parsed.netloc.endswith("sinaimg.cn") and name:
+            size = os.path.basename(os.path.dirname(parsed.path))
+            if size != "large" and size in MediaFilter.IMAGE_SIZES:
+                return f"img-{size}-{name}{ext.lower()}"
+            return f"img-{name}{ext.lower()}"
+        digest = hashlib.sha1(parsed.path.encode("utf-8")).hexdigest()
+        return f"vid-{digest}{ext.lower()}"
+
+    def _object_path(self, key):
+        return os.path.join(self.root, "objects", hashlib.sha1(key.encode("utf-8")).hexdigest()[:2], key)
+
+    def _lookup(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT path, size FROM objects WHERE key = ?", (key,)).fetchone()
+        if row and os.path.exists(row[0]):
+            return row
+        return None
+
+    @staticmethod
+    def _link(src, dst):
+        """依次尝试硬链接、reflink，都不支持时复制"""
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+        try:
+            import fcntl
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), MediaStore.FICLONE, fsrc.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        shutil.copyfile(src, dst)
+
+    def link_into(self, url, path):
+        """库中已有该媒体时直接链接到目标路径，不发起网络请求"""
+        row = self._lookup(self.media_key(url))
+        if not row:
+            return False
+        try:
+            self._link(row[0], path)
+        except OSError as e:
+            logging.warning(f"媒体库链接失败 {path}:{str(e)}")
+            return False
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += row[1]
+        return True
+
+    def add(self, url, path):
+        """把刚下载完成的文件登记进媒体库"""
+        key = self.media_key(url)
+        object_path = self._object_path(key)
+        try:
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                self._link(path, object_path)
+            size = os.path.getsize(object_path)
+            with self._lock:
+                self._conn.execute("INSERT OR REPLACE INTO objects (key, path, size) VALUES (?, ?, ?)",
+                                   (key, object_path, size))
+                self._conn.commit()
+        except OSError as e:
+            logging.warning(f"登记媒体库失败 {path}:{str(e)}")
+
+    def discard(self, url):
+        """文件校验失败时从库中删除该媒体，避免再次链接到损坏的内容"""
+        key = self.media_key(url)
+        with self._lock:
+            row = self._conn.execute("SELECT path FROM objects WHERE key = ?", (key,)).fetchone()
+            self._conn.execute("DELETE FROM objects WHERE key = ?", (key,))
+            self._conn.commit()
+        if row:
+            try:
+                os.remove(row[0])
+            except OSError:
+                pass
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# 文件开头的特征字节，用于识别 CDN 返回 200 但内容不是图片的情况
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+)
+VIDEO_BOXES = (b'ftyp', b'moov', b'mdat', b'free', b'wide', b'skip')  # MP4/MOV 第一个 box 的类型
+TRANSCODED_EXTS = {'.jpg': ('.webp', '.avif'), '.mov': ('.mp4',)}  # 转码后原文件被替换成的扩展名
+
+def image_kind(head):
+    for signature, kind in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return kind
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[4:8] == b'ftyp' and head[8:12] in (b'heic', b'heix', b'avif', b'mif1'):
+        return 'heif'
+    return None
+
+def verify_media_file(path, decode=False):
+    """检查一个已下载的媒体文件，正常时返回 None，否则返回原因；在进程池中执行，不能写日志
+
+    检查空文件、HTML/JSON 错误页、文件头特征字节和 JPEG/PNG 结束标记；decode=True 且安装了 Pillow 时完整解码图片
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        root, ext = os.path.splitext(path)
+        if any(os.path.exists(root + other) for other in TRANSCODED_EXTS.get(ext.lower(), ())):
+            return None  # 已被转码替换
+        return "文件不存在"
+    if size == 0:
+        return "空文件"
+    with open(path, 'rb') as f:
+        head = f.read(64)
+        f.seek(max(0, size - 64))
+        tail = f.read()
+    if head.lstrip()[:1] in (b'<', b'{'):
+        return "内容是 HTML/JSON 错误页"
+    if path.lower().endswith(('.mp4', '.mov')):
+        return None if head[4:8] in VIDEO_BOXES else "不是 MP4/MOV 文件"
+    kind = image_kind(head)
+    if kind is None:
+        return "不是图片文件"
+    if kind == 'jpeg' and b'\xff\xd9' not in tail:
+        return "JPEG 不完整（缺少结束标记）"
+    if kind == 'png' and b'IEND' not in tail:
+        return "PNG 不完整（缺少结束块）"
+    if decode:
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+        try:
+            with Image.open(path) as image:
+                image.load()
+        except Exception as e:
+            return f"图片无法解码:{str(e)}"
+    return None
+
+def transcode_media_file(path, image_format=None, remux_live=False):
+    """JPEG 图片转为 image_format（webp / avif），实况照片 mov 无损转封装为 mp4；成功后替换原文件
+
+    返回 (新路径, None)、(None, 失败原因) 或 (None, None)（不需要转码）；在进程池中执行
+    """
+    root, ext = os.path.splitext(path)
+    ext = ext.lower()
+    if ext == '.mov' and remux_live:
+        target = root + '.mp4'
+        tmp_path = target + '.tmp'
+        try:
+            result = subprocess.run(['ffmpeg', '-v', 'error', '-y', '-i', path, '-c', 'copy', '-movflags', '+faststart',
+                                     '-f', 'mp4', tmp_path], capture_output=True, timeout=300)
+        except (OSError, subprocess.SubprocessError) as e:
+            return None, f"ffmpeg 运行失败:{str(e)}"
+        if result.returncode != 0:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None, f"ffmpeg 转封装失败:{result.stderr.decode('utf-8', 'replace').strip()[:200]}"
+    elif ext == '.jpg' and image_format:
+        target = f"{root}.{image_format}"
+        tmp_path = target + '.tmp'
+        try:
+            from PIL import Image
+            with Image.open(path) as image:
+                if image.format != 'JPEG':
+                    return None, None  # GIF 等按原样保留
+                image.save(tmp_path, format=image_format.upper(), quality=85)
         except Exception as e:
-            print(f"获取用户名异常: {e}")
-        return f"用户_{uid}"
-
-    def get_download_dir(self, base_dir, uid):
-        """获取或创建下载目录，基于用户名和 UID"""
-        for subdir in os.listdir(base_dir):
-            subdir_path = os.path.join(base_dir, subdir)
-            if os.path.isdir(subdir_path) and uid in subdir:
-                print(f'检测到同名文件夹 "{uid}"，跳过通过API获取用户名')
-                return subdir_path
-        username = self.get_username(uid)
-        new_folder_name = f"{username}_{uid}"
-        new_folder_path = os.path.join(base_dir, new_folder_name)
-        os.makedirs(new_folder_path, exist_ok=True)
-        print(f"创建新文件夹: {new_folder_path}")
-        return new_folder_path
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None, f"图片转码失败:{str(e)}"
+    else:
+        return None, None
+    os.replace(tmp_path, target)
+    os.remove(path)
+    return target, None
+
+class MediaPostProcessor:
+    """下载后的媒体校验和可选转码，在两个独立的进程池中执行：
+
+    校验由保存微博的线程提交并等待，发现损坏时删除后重新下载；转码提交后不等待，
+    CPU 密集的编码不会拖慢下载线程和接口请求，结束时 close() 等待剩余转码完成
+    """
+    IMAGE_FORMATS = ("webp", "avif")
+    MAX_REDOWNLOADS = 1  # 校验失败后重新下载的次数，仍失败则按下载失败处理
+
+    def __init__(self, workers=2, decode=False, image_format=None, remux_live=False, verify=True):
+        if image_format and image_format not in self.IMAGE_FORMATS:
+            raise ValueError(f"不支持的图片格式:{image_format}，可选 {', '.join(self.IMAGE_FORMATS)}")
+        if image_format:
+            try:
+                import PIL  # noqa: F401  图片转码需要 Pillow
+            except ImportError:
+                logging.warning("未安装 Pillow，不转码图片")
+                image_format = None
+        if remux_live and not shutil.which("ffmpeg"):
+            logging.warning("找不到 ffmpeg，不转封装实况照片")
+            remux_live = False
+        self.workers = workers
+        self.decode = decode
+        self.image_format = image_format
+        self.remux_live = remux_live
+        # spawn 启动的子进程不继承下载线程持有的锁
+        context = multiprocessing.get_context("spawn")
+        self.verify_pool = ProcessPoolExecutor(max_workers=workers, mp_context=context) if verify else None
+        self.transcode_pool = ProcessPoolExecutor(max_workers=workers, mp_context=context) \
+            if image_format or remux_live else None
+        self._transcoding = set()
+        self._lock = threading.Lock()
+        self.stats = {'verified': 0, 'bad': 0, 'transcoded': 0, 'transcode_failed': 0}
+
+    @property
+    def verifying(self):
+        """开启校验时新下载的文件要等校验通过后才登记进媒体库"""
+        return self.verify_pool is not None
+
+    def verify(self, paths):
+        """并行校验，按顺序返回每个文件的问题（正常为 None）；未开启校验时全部返回 None"""
+        if not paths or not self.verify_pool:
+            return [None] * len(paths)
+        chunksize = max(1, len(paths) // (self.workers * 4))  # 大批量时减少进程间往返
+        with METRICS.timer("weibo_media_verify_seconds"):
+            reasons = list(self.verify_pool.map(verify_media_file, paths, [self.decode] * len(paths),
+                                                chunksize=chunksize))
+        bad = sum(1 for reason in reasons if reason)
+        with self._lock:
+            self.stats['verified'] += len(paths)
+            self.stats['bad'] += bad
+        METRICS.inc("weibo_media_verify_total", len(paths) - bad, result="ok")
+        if bad:
+            METRICS.inc("weibo_media_verify_total", bad, result="bad")
+        return reasons
+
+    @staticmethod
+    def discard(url, path, media_store=None):
+        """删除校验失败的文件，连同媒体库中的同一份内容"""
+        for stale in (path, path + ".part"):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        if media_store:
+            media_store.discard(url)
+
+    def transcode(self, paths):
+        """提交转码，不等待结果"""
+        if not self.transcode_pool:
+            return
+        for path in paths:
+            if not path.lower().endswith(('.jpg', '.mov')):
+                continue
+            future = self.transcode_pool.submit(transcode_media_file, path, self.image_format, self.remux_live)
+            with self._lock:
+                self._transcoding.add(future)
+            future.add_done_callback(lambda done, path=path: self._transcoded(done, path))
+
+    def _transcoded(self, future, path):
+        with self._lock:
+            self._transcoding.discard(future)
+        try:
+            target, reason = future.result()
+        except Exception as e:
+            target, reason = None, str(e)
+        if reason:
+            logging.warning(f"转码失败 {path}:{reason}")
+        key = 'transcoded' if target else 'transcode_failed' if reason else None
+        if key:
+            with self._lock:
+                self.stats[key] += 1
+            METRICS.inc("weibo_media_transcode_total", result='ok' if target else 'failed')
+
+    def summary(self):
+        with self._lock:
+            stats, running = dict(self.stats), len(self._transcoding)
+        lines = []
+        if self.verify_pool:
+            lines.append(f"文件校验:检查 {stats['verified']} 个，损坏 {stats['bad']} 个")
+        if self.transcode_pool:
+            note = f"，还有 {running} 个进行中" if running else ""
+            lines.append(f"转码:完成 {stats['transcoded']} 个，失败 {stats['transcode_failed']} 个{note}")
+        return lines
+
+    def close(self):
+        """等待剩余的转码完成后关闭进程池"""
+        if self.transcode_pool:
+            self.transcode_pool.shutdown(wait=True)
+        if self.verify_pool:
+            self.verify_pool.shutdown(wait=True)
+
+def configure_post_processor(post_processor=None):
+    """设置全局下载后处理，传 None 时不校验也不转码"""
+    global POST_PROCESSOR
+    POST_PROCESSOR = post_processor
+
+POST_PROCESSOR = None  # 由 configure_post_processor 设置
+
+class TokenBucket:
+    """线程安全的令牌桶限速器，可被多个爬虫线程共享"""
+    def __init__(self, rate, capacity=1, name="api"):
+        self.rate = rate  # 每秒补充的令牌数
+        self.capacity = capacity  # 桶容量，即允许的突发请求数
+        self.name = name  # 指标标签，区分接口和 CDN 限速器
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens):
+        """令牌足够时取走并返回 0，否则返回还需等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """取走令牌，令牌不足时阻塞到补足为止"""
+        while True:
+            wait_time = self._take(tokens)
+            if not wait_time:
+                return
+            METRICS.inc("weibo_sleep_seconds_total", wait_time, reason="rate_limit", limiter=self.name)
+            time.sleep(wait_time)
+
+class WeiboThrottledError(Exception):
+    """接口被限流（418/429/5xx 或返回非 JSON），多次退避重试后仍失败"""
+
+class WeiboPostGoneError(Exception):
+    """单条微博已被删除或不存在，重试也不会成功"""
+
+class MediaBudgetExceeded(Exception):
+    """本次运行的下载字节预算已用完，这条微博留到下次运行"""
+
+class AdaptiveRateLimiter(TokenBucket):
+    """自适应限速器：接口正常时逐步提速，被限流时减速并指数退避（带随机抖动）
+
+    max_rate 为 None 时上限就是初始速率，只在限流减速后恢复，不会超过用户设定的速率
+    """
+    def __init__(self, rate=1.0, min_rate=0.05, max_rate=None, increase_step=0.05,
+                 backoff_base=2.0, backoff_cap=120.0):
+        super().__init__(rate)
+        self.configured_rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, rate) if max_rate else rate
+        self._above_configured = False  # 已提速到设定速率以上，越过时记一次日志
+        self.increase_step = increase_step  # 每次成功请求增加的速率（次/秒）
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._blocked_until = 0.0  # 退避期间所有共享该限速器的线程都暂停
+        self.throttle_events = 0
+        self.throttled_seconds = 0.0
+
+    def backoff_remaining(self):
+        """距退避结束还有多少秒，不在退避中时为 0 或负数"""
+        with self._lock:
+            return self._blocked_until - time.monotonic()
+
+    def acquire(self, tokens=1):
+        while True:
+            delay = self.backoff_remaining()
+            if delay <= 0:
+                break
+            METRICS.inc("weibo_sleep_seconds_total", delay, reason="backoff", limiter=self.name)
+            time.sleep(delay)
+        super().acquire(tokens)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+            crossed = self.rate > self.configured_rate and not self._above_configured
+            self._above_configured = self.rate > self.configured_rate
+        if crossed:
+            logging.info(f"限速器 {self.name} 的速率已超过设定的 {self.configured_rate:.2f} 次/秒，"
+                         f"最高提到 {self.max_rate:.2f} 次/秒（api_max_rate）")
+
+    def on_throttle(self, attempt):
+        """速率减半，并让所有线程退避 base * 2^attempt 秒（一半固定一半随机）"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.throttle_events += 1
+            ceiling = min(self.backoff_cap, self.backoff_base * (2 ** attempt))
+            delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+            now = time.monotonic()
+            new_until = now + delay
+            if new_until > self._blocked_until:
+                self.throttled_seconds += new_until - max(self._blocked_until, now)
+                self._blocked_until = new_until
+            return delay
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'current_rate': round(self.rate, 3),
+                'throttle_events': self.throttle_events,
+                'throttled_seconds': round(self.throttled_seconds, 2),
+            }
+
+class Credential:
+    """一个 Cookie 及其接口会话、限速器和健康状态"""
+    def __init__(self, index, cookie, limiter, pool=None):
+        self.index = index
+        self.name = f"Cookie#{index + 1}"
+        self.headers = {"Cookie": cookie}
+        self.limiter = limiter
+        self.pool = pool  # 线程后端下独立的接口连接池，为 None 时使用 API_POOL
+        self.in_flight = 0
+        self.requests = 0
+        self.throttles = 0
+        self.expirations = 0
+        self.cooldown_until = 0.0  # Cookie 失效后暂停使用到该时刻（monotonic）
+
+    def wait_seconds(self, now):
+        """还要等多久才能再用：失效冷却和限流退避取较长的一个"""
+        wait = self.cooldown_until - now
+        if isinstance(self.limiter, AdaptiveRateLimiter):
+            wait = max(wait, self.limiter.backoff_remaining())
+        return max(0.0, wait)
+
+class CredentialPool:
+    """多个 Cookie 组成的凭据池，每次接口请求选一个可用的 Cookie，总吞吐随 Cookie 数增加
+
+    least-loaded 选进行中请求最少的，round-robin 依次轮流；被限流的 Cookie 在自己的退避期内不被选中，
+    失效（跳转登录页）的 Cookie 冷却 EXPIRED_COOLDOWN 秒后再试。所有 Cookie 都要等待超过 MAX_WAIT 秒时
+    抛出 WeiboThrottledError，与单个 Cookie 被限流时一样提前结束
+    """
+    STRATEGIES = ("least-loaded", "round-robin")
+    EXPIRED_COOLDOWN = 1800
+    MAX_WAIT = 120
+
+    def __init__(self, credentials, strategy="least-loaded"):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"未知的 Cookie 调度方式:{strategy}，可选 {', '.join(self.STRATEGIES)}")
+        self.credentials = credentials
+        self.strategy = strategy
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _pick_locked(self, now):
+        """返回 (可用的凭据, None) 或 (None, 最短等待秒数)"""
+        ready = [credential for credential in self.credentials if credential.wait_seconds(now) == 0]
+        if not ready:
+            return None, min(credential.wait_seconds(now) for credential in self.credentials)
+        if self.strategy == "round-robin":
+            count = len(self.credentials)
+            for offset in range(count):
+                credential = self.credentials[(self._next + offset) % count]
+                if credential in ready:
+                    break
+            self._next = (credential.index + 1) % count
+        else:
+            credential = min(ready, key=lambda item: (item.in_flight, item.requests))
+        credential.in_flight += 1
+        credential.requests += 1
+        return credential, None
+
+    def _check_wait(self, wait):
+        if wait > self.MAX_WAIT:
+            raise WeiboThrottledError(f"所有 Cookie 都在冷却中，最早 {wait:.0f} 秒后可用")
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                credential, wait = self._pick_locked(time.monotonic())
+            if credential:
+                return credential
+            self._check_wait(wait)
+            METRICS.inc("weibo_sleep_seconds_total", wait, reason="credentials", limiter="api")
+            time.sleep(wait)
+
+    def release(self, credential, outcome):
+        """outcome 为 ok / throttled / expired / error，限流退避由凭据自己的限速器记录"""
+        with self._lock:
+            credential.in_flight -= 1
+            if outcome == 'expired':
+                credential.expirations += 1
+                credential.cooldown_until = time.monotonic() + self.EXPIRED_COOLDOWN
+            elif outcome == 'throttled':
+                credential.throttles += 1
+        if outcome == 'expired':
+            logging.warning(f"{credential.name} 已失效（跳转登录页），{self.EXPIRED_COOLDOWN} 秒内不再使用")
+        METRICS.inc("weibo_credential_requests_total", credential=credential.name, result=outcome)
+
+    def summary(self):
+        """每个 Cookie 的请求数、限流和失效次数及当前速率，供结束时的统计结果使用"""
+        lines = []
+        for credential in self.credentials:
+            rate = getattr(credential.limiter, 'rate', None)
+            lines.append(f"{credential.name}:请求 {credential.requests} 次，限流 {credential.throttles} 次，"
+                         f"失效 {credential.expirations} 次，当前速率 {rate:.2f} 次/秒")
+        return lines
+
+def configure_credentials(cookies=None, api_rate=1.0, api_max_rate=None, pool_size=4, http2=False,
+                          strategy="least-loaded"):
+    """有多个 Cookie 时建立凭据池，每个 Cookie 独立的会话和自适应限速器；只有一个时不建池，与原来完全相同"""
+    global CREDENTIALS
+    CREDENTIALS = None
+    if not cookies or len(cookies) < 2:
+        return None
+    credentials = []
+    for index, cookie in enumerate(cookies):
+        limiter = AdaptiveRateLimiter(api_rate, max_rate=api_max_rate)
+        limiter.name = f"api#{index + 1}"
+        pool = build_api_pool(f"接口 Cookie#{index + 1}", pool_size, http2)
+        credentials.append(Credential(index, cookie, limiter, pool))
+    CREDENTIALS = CredentialPool(credentials, strategy)
+    return CREDENTIALS
+
+CREDENTIALS = None  # 由 configure_credentials 设置，为 None 时每个 WeiboClient 用自己的 Cookie 和限速器
+
+class MediaDownloader:
+    """有界线程池媒体下载引擎，按主机限制并发，可被多条微博共享"""
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_workers=8, per_host_limit=4, limiter=None, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 media_store=None):
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.chunk_size = chunk_size
+        self.limiter = limiter  # 可选的全局 CDN 限速器
+        self.media_store = media_store  # 可选的跨微博、跨账号媒体去重库
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="media")
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """未显式传入下载器时使用的进程级默认实例"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def _host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host_limit)
+                self._host_semaphores[host] = semaphore
+            return semaphore
+
+    def _download(self, url, path, log_uid=None, check_exists=True):
+        set_log_uid(log_uid)  # 下载线程被所有账号共享，日志归属提交任务的账号
+        if check_exists and os.path.exists(path):
+            return True
+        if self.media_store and self.media_store.link_into(url, path):
+            return True
+        if self.limiter:
+            self.limiter.acquire()
+        with self._host_semaphore(url):
+            done = WeiboUtils.download_media(url, path, self.chunk_size, check_exists=False)
+        if done and self.media_store and not (POST_PROCESSOR and POST_PROCESSOR.verifying):
+            self.media_store.add(url, path)
+        return done
+
+    def submit(self, url, path, check_exists=True):
+        """提交单个下载任务，返回 Future，结果为是否成功"""
+        return self.executor.submit(self._download, url, path, current_log_uid(), check_exists)
+
+    def download_each(self, tasks, check_exists=True):
+        """并发下载 (url, path) 列表，等待全部结束，按顺序返回每个文件是否成功"""
+        futures = [self.submit(url, path, check_exists) for url, path in tasks]
+        return [future.result() for future in futures]
+
+    def _probe(self, url):
+        with self._host_semaphore(url):
+            return WeiboUtils.probe_size(url)
+
+    def probe_sizes(self, urls):
+        """并发 HEAD 请求，按顺序返回每个文件的大小（拿不到时为 None）"""
+        return list(self.executor.map(self._probe, urls))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+class Media:
+    """微博中的一张图片（type='image'）或实况照片（type='live'，附带 mov 地址）"""
+    __slots__ = ('type', 'jpg_url', 'mov_url')
 
-    def get_interval(self):
-        """获取用户指定的下载间隔"""
-        user_interval = input("请输入 float 类型下载间隔（秒，默认 3）:").strip()
-        if not user_interval:
-            return 3
-        else:
-            try:
-                float_user_interval = float(user_interval)
-                print("您现在输入的间隔是:", float_user_interval, "秒")
-                return float_user_interval
-            except ValueError:
-                print("输入无效，默认使用 3 秒")
-                return 3
+    def __init__(self, type, jpg_url, mov_url=None):
+        self.type = type
+        self.jpg_url = jpg_url
+        self.mov_url = mov_url
 
-    def update_for_uid(self, uid):
-        """更新当前处理的 UID 相关属性"""
-        self.uid = uid
-        self.download_dir = self.get_download_dir(self.base_dir, uid)
-        self.username = self.get_username(uid)
-        self.saved_url_filename = os.path.join(self.download_dir, "saved_urls.log")
-        self.unsaved_url_filename = os.path.join(self.download_dir, "unsaved_urls.log")
-        self.date_log_filename = os.path.join(self.download_dir, "date.log")
-        if not os.path.exists(self.download_dir):
-            os.makedirs(self.download_dir)
-
-class URLManager:
-    """管理已成功保存的 URL, 防止重复下载"""
-    def __init__(self):
-        self.visited = set()
+    def to_dict(self):
+        data = {'type': self.type, 'jpg_url': self.jpg_url}
+        if self.mov_url:
+            data['mov_url'] = self.mov_url
+        return data
 
-    def add_url(self, url):
-        if url in self.visited:
-            return False
-        self.visited.add(url)
-        return True
+class Post:
+    """parse_weibo 解析出的一条微博，只保留下载和去重用到的字段"""
+    __slots__ = ('time', 'content', 'pics', 'video', 'url', 'bid', 'pinned', 'publish_time', 'text_path',
+                 'video_filtered')
 
-    def has_url(self, url):
-        return url in self.visited
+    def __init__(self, time, content, pics, video, url, bid, pinned, publish_time, video_filtered=False):
+        self.time = time  # 文件名用的时间 %Y-%m-%d-%H-%M-%S
+        self.content = content
+        self.pics = pics  # [Media]
+        self.video = video
+        self.video_filtered = video_filtered  # 没有不超过 --max-video-resolution 的清晰度，视频不下载
+        self.url = url
+        self.bid = bid
+        self.pinned = pinned
+        self.publish_time = publish_time  # %Y%m%d%H%M%S，用于比较先后
+        self.text_path = None  # save_weibo 确定的正文文件路径，不写正文文件时也会设置，供元数据清单导出
 
-    def get_all_urls(self):
-        return list(self.visited)
+class MediaFilter:
+    """下载前的媒体筛选：类型、图片尺寸、视频清晰度和大小、发布日期范围以及本次运行的字节预算
 
-class FileManager:
-    """管理 URL 文件和 date.log 文件的加载、追加及更新"""
-    def __init__(self, save_dir):
-        self.save_dir = save_dir
+    所有判断都在请求媒体之前完成，被筛掉的文件不会产生任何 CDN 流量或磁盘写入。
+    类型有 image（图片和实况照片的静态图）、live（实况照片的 mov）、video（视频）、text（纯文字微博的 txt）。
+    """
+    KINDS = ("image", "live", "video", "text")
+    IMAGE_SIZES = ("large", "mw2000", "mw1024", "mw690")  # sinaimg 路径中的尺寸名，从大到小
 
-    @staticmethod
-    def load_urls(file_path):
-        if not os.path.exists(file_path):
-            return []
-        with open(file_path, "r", encoding="utf-8") as f:
-            return [line.strip() for line in f if line.strip()]
+    def __init__(self, include=None, exclude=None, image_size=None, max_video_resolution=None, max_video_mb=None,
+                 byte_budget_mb=None, since=None, until=None):
+        include = self._kind_set(include) or set(self.KINDS)
+        self.kinds = include - self._kind_set(exclude)
+        if image_size and image_size not in self.IMAGE_SIZES:
+            raise ValueError(f"不支持的图片尺寸:{image_size}，可选 {', '.join(self.IMAGE_SIZES)}")
+        self.image_size = image_size if image_size != "large" else None
+        self.max_video_height = int(max_video_resolution) if max_video_resolution else None
+        self.max_video_bytes = int(max_video_mb * 1048576) if max_video_mb else None
+        self.byte_budget = int(byte_budget_mb * 1048576) if byte_budget_mb else None
+        # 与 Post.publish_time 同为 %Y%m%d%H%M%S，可直接按字符串比较
+        self.since = self._parse_date(since) + "000000" if since else None
+        self.until = self._parse_date(until) + "235959" if until else None
+        self.bytes_reserved = 0
+        self.exhausted = False
+        self._lock = threading.Lock()
 
-    @staticmethod
-    def append_url(file_path, url):
-        with open(file_path, "a", encoding="utf-8") as f:
-            f.write(url + "\n")
+    @classmethod
+    def _kind_set(cls, kinds):
+        if not kinds:
+            return set()
+        if isinstance(kinds, str):
+            kinds = kinds.split(',')
+        kinds = {kind.strip() for kind in kinds if kind.strip()}
+        unknown = kinds - set(cls.KINDS)
+        if unknown:
+            raise ValueError(f"未知的媒体类型:{', '.join(sorted(unknown))}，可选 {', '.join(cls.KINDS)}")
+        return kinds
 
     @staticmethod
-    def append_date(file_path, date_str):
-        with open(file_path, "a", encoding="utf-8") as f:
-            f.write(date_str + "\n")
+    def _parse_date(value):
+        try:
+            return datetime.strptime(str(value), "%Y-%m-%d").strftime("%Y%m%d")
+        except ValueError:
+            raise ValueError(f"日期格式应为 YYYY-MM-DD:{value}")
 
-    @staticmethod
-    def update_unsaved_file(file_path, unsaved_set):
-        with open(file_path, "w", encoding="utf-8") as f:
-            for url in unsaved_set:
-                f.write(url + "\n")
-
-    def read_date_log_first_line(self):
-        date_log_path = os.path.join(self.save_dir, 'date.log')
-        if os.path.exists(date_log_path):
-            with open(date_log_path, 'r', encoding='utf-8') as f:
-                first_line = f.readline().strip()
-                if first_line:
-                    return first_line
-        return None
+    @property
+    def probing(self):
+        """是否需要先用 HEAD 请求取得文件大小"""
+        return bool(self.max_video_bytes or self.byte_budget)
 
-    def sort_date_log(self):#排序
-        date_log_path = os.path.join(self.save_dir, 'date.log')
-        if os.path.exists(date_log_path):
-            with open(date_log_path, 'r', encoding='utf-8') as f:
-                dates = [line.strip() for line in f if line.strip()]
-            if dates:
-                dates.sort(reverse=True)  # 大的在上（时间晚的在上）
-                with open(date_log_path, 'w', encoding='utf-8') as f:
-                    for date in dates:
-                        f.write(date + "\n")
+    @property
+    def partial(self):
+        """是否会只保存微博的部分媒体（类型、尺寸、清晰度或大小受限），这样保存的页不算完整覆盖"""
+        return bool(set(self.KINDS) - self.kinds or self.image_size or self.max_video_height or self.max_video_bytes)
 
-class WeiboUtils:
-    """工具方法集合"""
-    @staticmethod
-    def clean_content(content):
-        content = re.sub(r'<[^>]+>', '', content)
-        content = re.sub(r'[\n\r]', ' ', content)
-        cleaned = re.sub(r'[^\u4e00-\u9fa5a-zA-Z0-9_\s-]', '', content)
-        cleaned = re.sub(r'\s+', ' ', cleaned).rstrip()
-        return cleaned[:20].rstrip()
+    def wants(self, kind):
+        return kind in self.kinds
 
-    @staticmethod
-    def get_valid_filename(name):
-        name = re.sub(r'[\\/*?:"<>|\n\r]', '', name)
-        return name.rstrip()
+    def image_url(self, url):
+        """按配置的尺寸改写 sinaimg 图片地址，未配置或地址不是 /large/ 时原样返回"""
+        if self.image_size and "/large/" in url:
+            return url.replace("/large/", f"/{self.image_size}/", 1)
+        return url
+
+    def date_position(self, publish_time):
+        """早于 since 返回 -1，晚于 until 返回 1，在范围内返回 0"""
+        if self.since and publish_time < self.since:
+            return -1
+        if self.until and publish_time > self.until:
+            return 1
+        return 0
+
+    def admit(self, tasks, downloader):
+        """对即将下载的 (url, path) 做大小检查：去掉超过上限的视频，并从字节预算中预留其余文件的大小
+
+        拿不到 Content-Length 的文件按 0 计；预算不够时抛出 MediaBudgetExceeded，此后本次运行不再下载
+        """
+        if self.exhausted:
+            raise MediaBudgetExceeded(f"已用 {self.bytes_reserved / 1048576:.1f} MB")
+        if not tasks or not self.probing:
+            return tasks
+        sizes = downloader.probe_sizes([url for url, _ in tasks])
+        admitted = []
+        total = 0
+        for (url, path), size in zip(tasks, sizes):
+            if self.max_video_bytes and size and size > self.max_video_bytes and path.endswith('.mp4'):
+                logging.info(f"视频 {size / 1048576:.1f} MB 超过上限，跳过:{url}")
+                continue
+            admitted.append((url, path))
+            total += size or 0
+        with self._lock:
+            if self.byte_budget is not None and self.bytes_reserved + total > self.byte_budget:
+                self.exhausted = True
+                raise MediaBudgetExceeded(f"已用 {self.bytes_reserved / 1048576:.1f} MB，"
+                                          f"预算 {self.byte_budget / 1048576:.1f} MB")
+            self.bytes_reserved += total
+        return admitted
+
+def configure_media_filter(media_filter=None):
+    """设置全局媒体筛选，传 None 时下载全部媒体"""
+    global MEDIA_FILTER
+    MEDIA_FILTER = media_filter
+
+MEDIA_FILTER = None  # 由 configure_media_filter 设置
+
+class CardStreamParser:
+    """用 ijson 流式解析 getIndex 响应，只取 card_type 和 cards[].mblog 中用到的字段，不构建完整对象树"""
+    CARD = 'data.cards.item'
+    MBLOG = CARD + '.mblog'
+    FIELDS = {
+        MBLOG + '.created_at': ('created_at',),
+        MBLOG + '.text': ('text',),
+        MBLOG + '.bid': ('bid',),
+        MBLOG + '.isTop': ('isTop',),
+        MBLOG + '.mblogtype': ('mblogtype',),
+        MBLOG + '.user.id': ('user', 'id'),
+        MBLOG + '.page_info.media_info.stream_url_hd': ('page_info', 'media_info', 'stream_url_hd'),
+        MBLOG + '.page_info.media_info.stream_url': ('page_info', 'media_info', 'stream_url'),
+        MBLOG + '.page_info.media_info.mp4_720p_mp4': ('page_info', 'media_info', 'mp4_720p_mp4'),
+        MBLOG + '.page_info.media_info.mp4_hd_url': ('page_info', 'media_info', 'mp4_hd_url'),
+        MBLOG + '.page_info.media_info.mp4_sd_url': ('page_info', 'media_info', 'mp4_sd_url'),
+        MBLOG + '.page_info.urls.mp4_1080p_mp4': ('page_info', 'urls', 'mp4_1080p_mp4'),
+        MBLOG + '.page_info.urls.mp4_720p_mp4': ('page_info', 'urls', 'mp4_720p_mp4'),
+        MBLOG + '.page_info.urls.mp4_hd_mp4': ('page_info', 'urls', 'mp4_hd_mp4'),
+        MBLOG + '.page_info.urls.mp4_ld_mp4': ('page_info', 'urls', 'mp4_ld_mp4'),
+    }
+    PIC_ITEMS = {MBLOG + '.pics.item': (), MBLOG + '.retweeted_status.pics.item': ('retweeted_status',)}
+    SCALAR_EVENTS = ('string', 'number', 'boolean', 'null')
+
+    def __init__(self):
+        import ijson
+        self._ijson = ijson
+        self._pic_fields = {}
+        for item_prefix in self.PIC_ITEMS:
+            self._pic_fields[item_prefix + '.large.url'] = 'large'
+            self._pic_fields[item_prefix + '.live_photo'] = 'live_photo'
 
     @staticmethod
-    def safe_mkdir(path):
+    def _container(mblog, path):
+        for key in path:
+            mblog = mblog.setdefault(key, {})
+        return mblog
+
+    def parse(self, content):
+        """返回与 data.cards 结构相同的精简列表，JSON 不完整时抛出 ValueError"""
+        cards = []
+        card = mblog = None
+        pics = None
         try:
-            os.makedirs(path, exist_ok=True)
-            return path
-        except OSError:
-            base, name = os.path.split(path)
-            truncated = name[:50 - len(base) - 1]
-            return WeiboUtils.safe_mkdir(os.path.join(base, truncated))
+            for prefix, event, value in self._ijson.parse(content):
+                if prefix == self.CARD:
+                    if event == 'start_map':
+                        card, mblog = {}, None
+                    elif event == 'end_map':
+                        cards.append(card)
+                elif prefix == self.CARD + '.card_type':
+                    card['card_type'] = value
+                elif prefix == self.MBLOG:
+                    if event == 'start_map':
+                        mblog = card['mblog'] = {}
+                elif mblog is None:
+                    continue
+                elif prefix in self.PIC_ITEMS:
+                    if event == 'start_map':
+                        pics = self._container(mblog, self.PIC_ITEMS[prefix]).setdefault('pics', [])
+                        pics.append({})
+                elif event in self.SCALAR_EVENTS:
+                    if prefix in self.FIELDS:
+                        *path, key = self.FIELDS[prefix]
+                        self._container(mblog, path)[key] = value
+                    elif prefix in self._pic_fields and pics:
+                        if self._pic_fields[prefix] == 'large':
+                            pics[-1]['large'] = {'url': value}
+                        else:
+                            pics[-1]['live_photo'] = value
+        except self._ijson.JSONError as e:
+            raise ValueError(f"JSON 解析失败:{str(e)}")
+        return cards
 
-    @staticmethod
-    def download_media(url, path):
-        if os.path.exists(path):
-            return True
+def configure_card_parser(stream_json=False):
+    """安装了 ijson 时用流式解析器处理微博列表，否则整页 json.loads"""
+    global CARD_PARSER
+    CARD_PARSER = None
+    if stream_json:
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0',
-                'Referer': 'https://weibo.com/'
-            }
-            response = SESSION.get(url, headers=headers, stream=True, timeout=20)
-            if response.status_code == 200:
-                with open(path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                return True
-        except Exception as e:
-            logging.error(f"下载失败 {url}:{str(e)}")
-        return False
+            CARD_PARSER = CardStreamParser()
+        except ImportError:
+            logging.info("未安装 ijson，微博列表使用整页 JSON 解析")
+
+CARD_PARSER = None  # 可选的 CardStreamParser，由 configure_card_parser 设置
 
 class WeiboClient:
     """封装微博相关的接口调用与数据解析"""
-    def __init__(self, uid, cookie):
+    THROTTLE_STATUS = (418, 429)
+    LOGIN_HOSTS = ("passport.weibo.cn", "passport.weibo.com", "login.sina.com.cn")  # Cookie 失效时跳转到这些主机
+    LOGIN_JSON = re.compile(rb'\s*\{\s*"ok"\s*:\s*-100\b')  # 未登录时接口返回 {"ok":-100,"url":登录页}
+    MAX_API_RETRIES = 5
+    API_BASE = "https://m.weibo.cn"  # bench/ 中的基准测试会改指向本地模拟服务器
+
+    def __init__(self, uid, cookie, downloader=None, api_limiter=None, profile_cache=None):
         self.uid = uid
         self.cookie = cookie
+        self.profile_cache = profile_cache  # 可选的 ProfileCache，多次运行间共享
+        self._profile = None
+        self.downloader = downloader if downloader else MediaDownloader.shared()
+        # 多个账号共享的接口限速器，未传入时使用独立的自适应限速器
+        self.api_limiter = api_limiter if api_limiter else AdaptiveRateLimiter()
+        # 未配置凭据池时所有请求都用这个 Cookie；User-Agent 由接口会话统一设置
+        self._credential = Credential(0, cookie, self.api_limiter)
 
-    def get_containerid(self):
-        profile_url = f"https://m.weibo.cn/api/container/getIndex?type=uid&value={self.uid}"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0",
-            "Cookie": self.cookie
+    def _acquire_credential(self):
+        return CREDENTIALS.acquire() if CREDENTIALS else self._credential
+
+    @staticmethod
+    def _release_credential(credential, outcome):
+        if CREDENTIALS:
+            CREDENTIALS.release(credential, outcome)
+
+    def _api_get(self, url, timeout=10, parse=None):
+        """请求微博接口并返回 JSON（传入 parse 时返回 parse(响应字节)），被限流时退避重试，重试耗尽抛出 WeiboThrottledError"""
+        endpoint = urlparse(url).path.rsplit('/', 1)[-1]  # getIndex / show
+        reason = ""
+        for attempt in range(self.MAX_API_RETRIES):
+            credential = self._acquire_credential()
+            credential.limiter.acquire()
+            start = time.perf_counter()
+            status = "error"
+            outcome = "error"
+            try:
+                response = (credential.pool or API_POOL).get(url, headers=credential.headers, timeout=timeout)
+                status = response.status_code
+                outcome, result = self._read_api_response(response, endpoint, parse, credential)
+                if outcome == 'ok':
+                    return result
+                reason = result
+            except ValueError:
+                reason = "返回内容不是 JSON"  # 通常是验证码
+            except requests.RequestException as e:
+                reason = f"网络错误 {str(e)}"
+            finally:
+                self._record_api_call(endpoint, status, start, attempt)
+                self._release_credential(credential, outcome)
+            delay = self._api_retry_delay(url, endpoint, attempt, reason, credential, outcome)
+            if delay:
+                time.sleep(delay)
+        raise WeiboThrottledError(f"{reason}:{url}")
+
+    def _read_api_response(self, response, endpoint, parse, credential):
+        """返回 ('ok', 数据)；被限流或服务器出错时返回 ('throttled', 原因)，Cookie 失效时返回 ('expired', 原因)，
+        内容不是 JSON 时抛出 ValueError。只有启用凭据池时才识别 Cookie 失效，单个 Cookie 时与原来一样"""
+        if CREDENTIALS and self._is_login_response(response):
+            return 'expired', "Cookie 已失效（跳转登录页）"
+        if response.status_code in self.THROTTLE_STATUS or response.status_code >= 500:
+            return 'throttled', f"状态码 {response.status_code}"
+        with METRICS.timer("weibo_api_parse_seconds", endpoint=endpoint):
+            data = parse(response.content) if parse else response.json()
+        if isinstance(credential.limiter, AdaptiveRateLimiter):
+            credential.limiter.on_success()
+        return 'ok', data
+
+    def _is_login_response(self, response):
+        """请求被重定向到登录页，或接口返回 ok=-100"""
+        if urlparse(response.url).netloc in self.LOGIN_HOSTS:
+            return True
+        return response.status_code == 200 and self.LOGIN_JSON.match(response.content[:64]) is not None
+
+    @staticmethod
+    def _record_api_call(endpoint, status, start, attempt):
+        elapsed = time.perf_counter() - start
+        METRICS.observe("weibo_api_request_seconds", elapsed, endpoint=endpoint, status=status)
+        METRICS.event('api', endpoint=endpoint, status=status, seconds=round(elapsed, 4), attempt=attempt)
+
+    def _api_retry_delay(self, url, endpoint, attempt, reason, credential, outcome):
+        """记录一次失败，返回调用方还需自行等待的秒数；自适应限速器的退避在下次 acquire 时等待
+
+        凭据池中的 Cookie 失效时已由凭据池冷却，立即换一个 Cookie 重试
+        """
+        METRICS.inc("weibo_api_retries_total", endpoint=endpoint)
+        if CREDENTIALS and outcome == 'expired':
+            logging.warning(f"{credential.name} {reason}，换一个 Cookie 第 {attempt + 1} 次重试:{url}")
+            return 0
+        limiter = credential.limiter
+        if isinstance(limiter, AdaptiveRateLimiter):
+            delay = limiter.on_throttle(attempt)
+            logging.warning(f"接口被限流（{reason}），{delay:.1f} 秒后第 {attempt + 1} 次重试:{url}")
+            return 0
+        METRICS.inc("weibo_sleep_seconds_total", 2 ** attempt, reason="backoff", limiter=limiter.name)
+        return 2 ** attempt
+
+    def _cached_profile(self):
+        if not self._profile and self.profile_cache:
+            self._profile = self.profile_cache.get(self.uid)
+        return self._profile
+
+    def _profile_url(self):
+        return f"{self.API_BASE}/api/container/getIndex?type=uid&value={self.uid}"
+
+    def get_profile(self):
+        """一次资料请求同时取得昵称、containerid 和 tabs，优先使用缓存，被限流时抛出 WeiboThrottledError"""
+        return self._cached_profile() or self._store_profile(self._api_get(self._profile_url()))
+
+    def _store_profile(self, data):
+        """从资料接口的返回中取出昵称、containerid 和 tabs，拿到 containerid 时写入缓存"""
+        info = data.get('data', {})
+        tabs = [{'tab_type': tab.get('tab_type'), 'containerid': tab.get('containerid'), 'title': tab.get('title')}
+                for tab in info.get('tabsInfo', {}).get('tabs', [])]
+        containerid = next((tab['containerid'] for tab in tabs if tab['tab_type'] == 'weibo'), None)
+        profile = {
+            'screen_name': info.get('userInfo', {}).get('screen_name', ''),
+            'containerid': containerid,
+            'tabs': tabs,
         }
+        if containerid:  # 拿不到 containerid 多半是 Cookie 失效，不缓存
+            self._profile = profile
+            if self.profile_cache:
+                self.profile_cache.put(self.uid, profile)
+        return profile
+
+    def get_containerid(self):
+        """获取微博列表的 containerid，被限流时抛出 WeiboThrottledError"""
         try:
-            response = SESSION.get(profile_url, headers=headers, timeout=10)
-            data = response.json()
-            for tab in data.get('data', {}).get('tabsInfo', {}).get('tabs', []):
-                if tab.get('tab_type') == 'weibo':
-                    return tab.get('containerid')
+            return self.get_profile()['containerid']
+        except WeiboThrottledError:
+            raise
         except Exception as e:
             logging.error(f"获取 containerid 失败:{str(e)}")
         return None
 
     def get_user_screen_name(self):
-        profile_url = f"https://m.weibo.cn/api/container/getIndex?type=uid&value={self.uid}"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0",
-            "Cookie": self.cookie
-        }
+        """获取用户昵称，被限流时抛出 WeiboThrottledError，避免用错误的名字建目录"""
         try:
-            response = SESSION.get(profile_url, headers=headers, timeout=10)
-            data = response.json()
-            return data.get('data', {}).get('userInfo', {}).get('screen_name', '')
+            return self.get_profile()['screen_name']
+        except WeiboThrottledError:
+            raise
         except Exception as e:
             logging.error(f"获取用户昵称失败:{str(e)}")
         return ''
 
     def fetch_list(self, containerid, page=1):
-        api_url = f"https://m.weibo.cn/api/container/getIndex?containerid={containerid}&page={page}"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0",
-            "Cookie": self.cookie
-        }
-        try:
-            response = SESSION.get(api_url, headers=headers, timeout=15)
-            data = response.json()
-            return data.get('data', {}).get('cards', [])
-        except Exception as e:
-            logging.error(f"获取微博列表失败:{str(e)}")
-        return []
+        """获取一页微博，返回空列表表示已到末尾，被限流时抛出 WeiboThrottledError"""
+        return self._api_get(self._list_url(containerid, page), timeout=15, parse=self._cards_parser())
+
+    def _list_url(self, containerid, page):
+        return f"{self.API_BASE}/api/container/getIndex?containerid={containerid}&page={page}"
+
+    @staticmethod
+    def _cards_parser():
+        if CARD_PARSER:
+            return CARD_PARSER.parse
+        return lambda content: json.loads(content).get('data', {}).get('cards', [])
 
     def parse_weibo(self, card):
         if not card.get('mblog'):
             return None
         mblog = card['mblog']
-        created_at = mblog.get('created_at', '')
-        try:
-            dt = datetime.strptime(created_at, '%a %b %d %H:%M:%S %z %Y')
-            time_str = dt.strftime("%Y-%m-%d-%H-%M-%S")
-            publish_time = dt.strftime("%Y%m%d%H%M%S")  # 修改为 %Y%m%d%H%M%S 格式
-        except:
-            time_str = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-            publish_time = datetime.now().strftime("%Y%m%d%H%M%S")
-        content = WeiboUtils.clean_content(mblog.get('text', ''))
-        pics = []
-        if 'pics' in mblog:
-            for pic in mblog['pics']:
-                if 'live_photo' in pic:
-                    pics.append({'type': 'live', 'jpg_url': pic['large']['url'], 'mov_url': pic['live_photo']})
-                elif 'large' in pic:
-                    pics.append({'type': 'image', 'jpg_url': pic['large']['url']})
+        try:
+            dt = datetime.strptime(mblog.get('created_at', ''), '%a %b %d %H:%M:%S %z %Y')
+        except (TypeError, ValueError):
+            dt = datetime.now()
+        pics = self._parse_pics(mblog.get('pics'))
         retweeted_status = mblog.get('retweeted_status')
-        if retweeted_status and 'pics' in retweeted_status:
-            for pic in retweeted_status['pics']:
-                if 'live_photo' in pic:
-                    pics.append({'type': 'live', 'jpg_url': pic['large']['url'], 'mov_url': pic['live_photo']})
-                elif 'large' in pic:
-                    pics.append({'type': 'image', 'jpg_url': pic['large']['url']})
-        video_url = None
-        if 'page_info' in mblog and 'media_info' in mblog['page_info']:
-            video_info = mblog['page_info']['media_info']
-            video_url = video_info.get('stream_url_hd') or video_info.get('stream_url')
-        return {
-            'time': time_str,
-            'content': content,
-            'pics': pics,
-            'video': video_url,
-            'url': f"https://weibo.com/{mblog.get('user', {}).get('id')}/{mblog.get('bid')}",
-            'publish_time': publish_time
-        }
+        if retweeted_status:
+            pics.extend(self._parse_pics(retweeted_status.get('pics')))
+        video_url, video_filtered = self._pick_video(mblog.get('page_info') or {})
+        return Post(
+            time=dt.strftime("%Y-%m-%d-%H-%M-%S"),
+            content=WeiboUtils.clean_content(mblog.get('text', '')),
+            pics=pics,
+            video=video_url,
+            url=f"https://weibo.com/{mblog.get('user', {}).get('id')}/{mblog.get('bid')}",
+            bid=mblog.get('bid'),
+            pinned=mblog.get('isTop') == 1 or mblog.get('mblogtype') == 2,
+            publish_time=dt.strftime("%Y%m%d%H%M%S"),
+            video_filtered=video_filtered,
+        )
+
+    # page_info 中各清晰度视频地址所在的 (字段, 键) 和大致的分辨率高度，从高到低排列
+    VIDEO_QUALITIES = (
+        (('urls', 'mp4_1080p_mp4'), 1080),
+        (('urls', 'mp4_720p_mp4'), 720),
+        (('media_info', 'mp4_720p_mp4'), 720),
+        (('media_info', 'stream_url_hd'), 720),
+        (('media_info', 'mp4_hd_url'), 720),
+        (('urls', 'mp4_hd_mp4'), 480),
+        (('media_info', 'mp4_sd_url'), 480),
+        (('media_info', 'stream_url'), 480),
+        (('urls', 'mp4_ld_mp4'), 360),
+    )
+
+    @classmethod
+    def _pick_video(cls, page_info):
+        """返回 (视频地址, 是否因清晰度被筛掉)
+
+        未限制清晰度时与原来一样取 stream_url_hd 或 stream_url，限制时取不超过上限的最高清晰度；
+        没有符合的清晰度时仍返回默认地址，这条微博照样按视频微博处理，只是不下载视频
+        """
+        media_info = page_info.get('media_info')
+        if not media_info:
+            return None, False
+        default = media_info.get('stream_url_hd') or media_info.get('stream_url')
+        max_height = MEDIA_FILTER.max_video_height if MEDIA_FILTER else None
+        if not max_height:
+            return default, False
+        for (section, key), height in cls.VIDEO_QUALITIES:
+            urls = page_info.get(section)
+            if height <= max_height and isinstance(urls, dict) and urls.get(key):
+                return urls[key], False
+        return default, bool(default)
+
+    @staticmethod
+    def _parse_pics(pics):
+        """把接口的 pics 列表转成 Media，实况照片同时保留 jpg 和 mov"""
+        media = []
+        for pic in pics or ():
+            large = pic.get('large')
+            if not large:
+                continue
+            if 'live_photo' in pic:
+                media.append(Media('live', large['url'], pic['live_photo']))
+            else:
+                media.append(Media('image', large['url']))
+        return media
+
+    GONE_ERRNO = ("20101",)  # statuses/show 返回的“微博不存在”错误码
+    GONE_MESSAGES = ("不存在", "已被删除", "已删除")
 
     def get_weibo_by_bid(self, bid):
-        url = f"https://m.weibo.cn/statuses/show?id={bid}"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0",
-            "Cookie": self.cookie
-        }
+        """获取单条微博，被限流时抛出 WeiboThrottledError，微博已删除时抛出 WeiboPostGoneError"""
+        url = f"{self.API_BASE}/statuses/show?id={bid}"
         try:
-            response = SESSION.get(url, headers=headers, timeout=10)
-            logging.info(f"请求 URL: {url}")
-            logging.info(f"响应状态码: {response.status_code}")
-            logging.info(f"响应内容前200字符: {response.text[:200]}")
-            if not response.text.strip():
-                logging.error("响应内容为空")
-                return None
-            data = response.json()
-            mblog = data.get('data')
-            if mblog:
-                return self.parse_weibo({'mblog': mblog})
-            else:
-                logging.error("响应中未找到 'data' 字段")
-                return None
-        except json.JSONDecodeError as e:
-            logging.error(f"JSON 解析错误: {str(e)}，响应内容: {response.text[:500]}")
-            return None
+            logging.debug("请求 URL: %s", url)
+            return self._post_from_show(self._api_get(url), bid)
+        except (WeiboThrottledError, WeiboPostGoneError):
+            raise
         except Exception as e:
             logging.error(f"获取单条微博失败: {str(e)}")
             return None
 
-    def save_weibo(self, weibo, save_dir):
+    def _post_from_show(self, data, bid):
+        logging.debug("响应内容前200字符: %.200s", data)
+        mblog = data.get('data')
+        if mblog:
+            return self.parse_weibo({'mblog': mblog})
+        message = str(data.get('msg') or "")
+        if str(data.get('errno')) in self.GONE_ERRNO or any(word in message for word in self.GONE_MESSAGES):
+            raise WeiboPostGoneError(f"{message or '微博不存在'}:{bid}")
+        logging.error("响应中未找到 'data' 字段")
+        return None
+
+    @staticmethod
+    def write_content(txt_path, content, url):
+        """写正文文件，保存微博和从元数据清单导出共用"""
+        with METRICS.timer("weibo_disk_write_seconds", target="text"):
+            with open(txt_path, 'w', encoding='utf-8') as f:
+                f.write(f"内容:{content}\n链接:{url}")
+
+    def _write_content(self, txt_path, weibo):
+        """记下正文文件路径，关闭了 text_files 时不写文件"""
+        weibo.text_path = txt_path
+        if TEXT_FILES:
+            self.write_content(txt_path, weibo.content, weibo.url)
+
+    def _verify_downloads(self, files):
+        """设置了 POST_PROCESSOR 时校验下载完成的 (url, path, done)，损坏的删除后重新下载，仍损坏则记为失败
+
+        校验通过的文件才登记进媒体库，避免其他微博链接到损坏的内容；随后提交转码，返回更新后的列表
+        """
+        processor = POST_PROCESSOR
+        if not processor:
+            return files
+        files = list(files)
+        media_store = self.downloader.media_store
+        candidates = [index for index, (_, _, done) in enumerate(files) if done]
+        for attempt in range(processor.MAX_REDOWNLOADS + 1):
+            reasons = processor.verify([files[index][1] for index in candidates])
+            bad = [index for index, reason in zip(candidates, reasons) if reason]
+            for index, reason in zip(candidates, reasons):
+                if reason:
+                    url, path, _ = files[index]
+                    logging.warning(f"文件校验失败 {path}:{reason}")
+                    processor.discard(url, path, media_store)
+                    files[index] = (url, path, False)
+            if not bad or attempt == processor.MAX_REDOWNLOADS:
+                break
+            results = self.downloader.download_each([files[index][:2] for index in bad], check_exists=False)
+            for index, done in zip(bad, results):
+                files[index] = files[index][:2] + (done,)
+            candidates = [index for index in bad if files[index][2]]
+        if media_store and processor.verifying:
+            for url, path, done in files:
+                if done:
+                    media_store.add(url, path)
+        processor.transcode([path for _, path, done in files if done])
+        return files
+
+    def save_weibo(self, weibo, save_dir, store=None):
+        """下载并保存一条微博，传入 store 时记录每个媒体文件的完成情况
+
+        状态库里有这条微博的清单时按清单跳过已完成的文件，不再逐个查询文件是否存在。
+        设置了 MEDIA_FILTER 时被筛掉的文件直接不下载，其余文件的目录和编号与不筛选时相同
+        """
         plain_txt_dir = os.path.join(save_dir, "plain_txt")
         plain_videos_dir = os.path.join(save_dir, "plain_videos")
-        os.makedirs(plain_txt_dir, exist_ok=True)
-        os.makedirs(plain_videos_dir, exist_ok=True)
+        manifest = store.file_manifest(weibo.bid) if store else None
+        check_exists = manifest is None
+        stem = WeiboUtils.post_stem(weibo, store)
 
-        if not weibo['pics'] and not weibo['video']:
-            txt_filename = f"{weibo['time']}-{WeiboUtils.get_valid_filename(weibo['content'])}.txt"
-            txt_path = os.path.join(plain_txt_dir, txt_filename)
-            with open(txt_path, 'w', encoding='utf-8') as f:
-                f.write(f"内容:{weibo['content']}\n链接:{weibo['url']}")
-        elif not weibo['pics'] and weibo['video']:
-            video_filename = f"{weibo['time']}-{WeiboUtils.get_valid_filename(weibo['content'])}.mp4"
-            video_path = os.path.join(plain_videos_dir, video_filename)
-            if WeiboUtils.download_media(weibo['video'], video_path):
-                txt_filename = f"{weibo['time']}-{WeiboUtils.get_valid_filename(weibo['content'])}.txt"
-                txt_path = os.path.join(plain_videos_dir, txt_filename)
-                with open(txt_path, 'w', encoding='utf-8') as f:
-                    f.write(f"内容:{weibo['content']}\n链接:{weibo['url']}")
+        media_filter = MEDIA_FILTER
+
+        def wants(kind):
+            if kind == 'video' and weibo.video_filtered:
+                return False
+            return media_filter.wants(kind) if media_filter else True
+
+        if weibo.video_filtered:
+            logging.info(f"视频没有不超过 {media_filter.max_video_height}p 的清晰度，跳过:{weibo.url}")
+
+        def pending(tasks):
+            if manifest:
+                tasks = [(url, path) for url, path in tasks if not manifest.get(os.path.normpath(path))]
+            # 大小上限和字节预算在这里检查，预算不够时抛出 MediaBudgetExceeded，本条不写任何文件
+            return media_filter.admit(tasks, self.downloader) if media_filter else tasks
+
+        if not weibo.pics and not weibo.video:
+            if wants('text'):
+                if TEXT_FILES:
+                    WeiboUtils.ensure_dir(plain_txt_dir)
+                self._write_content(os.path.join(plain_txt_dir, f"{stem}.txt"), weibo)
+        elif not weibo.pics and weibo.video:
+            if not wants('video'):
+                return True
+            # 清单中有记录时沿用原路径，防重名加上的 -bid 在续传时不会丢失
+            video_path = next(iter(manifest)) if manifest else os.path.join(plain_videos_dir, f"{stem}.mp4")
+            tasks = pending([(weibo.video, video_path)])
+            if not tasks and not (manifest and manifest.get(os.path.normpath(video_path))):
+                return True  # 视频超过大小上限
+            WeiboUtils.ensure_dir(plain_videos_dir)
+            results = self.downloader.download_each(tasks, check_exists)
+            files = self._verify_downloads([(url, path, done) for (url, path), done in zip(tasks, results)])
+            done = all(file_done for _, _, file_done in files)
+            if store and files:
+                store.record_files(weibo.bid, files)
+            if done:
+                self._write_content(os.path.splitext(video_path)[0] + ".txt", weibo)
         else:
-            base_dir = os.path.join(save_dir, f"{weibo['time']}-{WeiboUtils.get_valid_filename(weibo['content'])}").rstrip()
-            actual_path = WeiboUtils.safe_mkdir(base_dir)
+            has_live = any(media.type == 'live' for media in weibo.pics)
+            if not (wants('image') or (has_live and wants('live')) or (weibo.video and wants('video'))):
+                return True  # 这条微博的媒体全部被筛掉，不创建目录
+            # 沿用清单中记录的目录，目录名被截短或加了 -bid 时续传路径也不变
+            post_dir = os.path.dirname(next(iter(manifest))) if manifest else os.path.join(save_dir, stem)
+            tasks = []
+            for media_count, media in enumerate(weibo.pics, start=1):
+                jpg_url = media_filter.image_url(media.jpg_url) if media_filter else media.jpg_url
+                if media.type == 'image':
+                    if wants('image'):
+                        tasks.append((jpg_url, os.path.join(post_dir, f"image_{media_count}.jpg")))
+                elif media.type == 'live':
+                    if wants('live'):
+                        tasks.append((media.mov_url, os.path.join(post_dir, f"live_photo_{media_count}.mov")))
+                    if wants('image'):
+                        tasks.append((jpg_url, os.path.join(post_dir, f"live_photo_{media_count}.jpg")))
+            if weibo.video and wants('video'):
+                tasks.append((weibo.video, os.path.join(post_dir, "video.mp4")))
+            # 先过预算检查再建目录，预算不够时不留下空目录
+            tasks = pending(tasks)
+            if manifest:
+                actual_path = post_dir
+                os.makedirs(actual_path, exist_ok=True)
+            else:
+                actual_path = WeiboUtils.safe_mkdir(post_dir)
+                if actual_path != post_dir:
+                    tasks = [(url, os.path.join(actual_path, os.path.basename(path))) for url, path in tasks]
+            video_path = os.path.join(actual_path, "video.mp4")
             txt_path = os.path.join(actual_path, "content.txt")
-            if not os.path.exists(txt_path):
-                with open(txt_path, 'w', encoding='utf-8') as f:
-                    f.write(f"内容:{weibo['content']}\n链接:{weibo['url']}")
-            media_count = 1
-            for media in weibo['pics']:
-                if media['type'] == 'image':
-                    media_path = os.path.join(actual_path, f"image_{media_count}.jpg")
-                    if not WeiboUtils.download_media(media['jpg_url'], media_path):
-                        return False
-                elif media['type'] == 'live':
-                    mov_path = os.path.join(actual_path, f"live_photo_{media_count}.mov")
-                    if not WeiboUtils.download_media(media['mov_url'], mov_path):
-                        return False
-                    jpg_path = os.path.join(actual_path, f"live_photo_{media_count}.jpg")
-                    if not WeiboUtils.download_media(media['jpg_url'], jpg_path):
-                        return False
-                media_count += 1
-            if weibo['video']:
-                video_path = os.path.join(actual_path, "video.mp4")
-                WeiboUtils.download_media(weibo['video'], video_path)
-        # 保存成功后，将发布时间追加到 date.log
-        date_log_path = os.path.join(save_dir, "date.log")
-        FileManager.append_date(date_log_path, weibo['publish_time'])
+            weibo.text_path = txt_path
+            # 有清单说明正文已在上次写入；没有清单的旧微博才检查文件
+            if not manifest and (manifest is not None or not os.path.exists(txt_path)):
+                self._write_content(txt_path, weibo)
+            # 图片帖中的视频不影响保存结果，与图片一起并发下载
+            video_future = None
+            if tasks and tasks[-1][1] == video_path:
+                video_future = self.downloader.submit(weibo.video, video_path, check_exists)
+                tasks = tasks[:-1]
+            results = self.downloader.download_each(tasks, check_exists)
+            files = [(url, path, done) for (url, path), done in zip(tasks, results)]
+            if video_future:
+                files.append((weibo.video, video_path, video_future.result()))
+            files = self._verify_downloads(files)
+            if store and files:
+                store.record_files(weibo.bid, files)
+            if not all(file_done for _, _, file_done in files[:len(tasks)]):
+                return False
         return True
 
 class DynamicProcessor:
-    def __init__(self, file_manager, client, url_manager, cutoff_time, method):
+    def __init__(self, file_manager, client, store, cutoff_time, method):
         self.file_manager = file_manager
         self.client = client
-        self.url_manager = url_manager
-        self.cutoff_time = cutoff_time  # 截止时间从 date.log 第一行读取
+        self.store = store
+        self.cutoff_time = cutoff_time  # 截止时间为状态库中最新已保存微博的发布时间
         self.method = method
 
-    def process_dynamic(self, weibo):
-        publish_time = weibo['publish_time']
+    def check_dynamic(self, weibo):
+        """只做截止时间、日期范围和去重判断，不下载，返回 'stop' / 'skip' / 'filtered' / 'save'
+
+        incremental / backfill 模式下 'skip' 表示状态库中已保存，由爬虫统计连续已知条数；
+        'filtered' 表示晚于 --until，只是本次不保存
+        """
+        publish_time = weibo.publish_time
+
+        position = MEDIA_FILTER.date_position(publish_time) if MEDIA_FILTER else 0
+        if position > 0:
+            return 'filtered'
+        if position < 0:
+            if weibo.pinned:
+                return 'filtered'
+            logging.info(f"发布时间 {publish_time} 早于 --since，停止处理")
+            return 'stop'
 
         if self.method == 'date':
             if self.cutoff_time and publish_time <= self.cutoff_time:
+                if weibo.pinned:
+                    return 'skip'  # 置顶微博可能很旧，不能据此停止
                 logging.info(f"达到或早于截止时间 {self.cutoff_time}，停止处理")
-                return False
+                return 'stop'
+
+        if self.method in ('incremental', 'backfill'):
+            if self.store.is_saved(weibo.bid):
+                return 'skip'
 
         if self.method == 'url':
-            if self.url_manager.has_url(weibo['url']):
-                logging.info(f"这条已经保存:{weibo['url']}")
-                return True
+            if self.store.is_saved(weibo.bid):
+                logging.info(f"这条已经保存:{weibo.url}")
+                return 'skip'
             if self.cutoff_time and publish_time <= self.cutoff_time:
                 logging.info(f"发布时间 {publish_time} 早于截止时间 {self.cutoff_time}，跳过")
-                return True  # 跳过但不停止爬取
+                return 'skip'  # 跳过但不停止爬取
+        return 'save'
 
-        if self.client.save_weibo(weibo, self.file_manager.save_dir):
-            self.url_manager.add_url(weibo['url'])
-            self.file_manager.append_url(os.path.join(self.file_manager.save_dir, "saved_urls.log"), weibo['url'])
-            logging.info(f"成功保存:{weibo['content']}")
+    def save_dynamic(self, weibo):
+        """下载并保存一条微博，成功后在状态库中标记为已保存"""
+        if self.client.save_weibo(weibo, self.file_manager.save_dir, self.store):
+            self.store.mark_saved(weibo)
+            logging.info(f"成功保存:{weibo.content}")
             return True
         else:
-            logging.error(f"保存失败:{weibo['url']}")
+            logging.error(f"保存失败:{weibo.url}")
             return False
 
 class WeiboCrawler:
-    def __init__(self, uid, save_dir, interval, method, cookie):
+    BACKFILL_STEP_BACK = 5  # 回溯起点与已覆盖历史之间有空隙时每次向前回退的页数
+    DEDUP_WINDOW = 40  # 入队去重窗口（约四页），更早的重复由状态库判定
+
+    def __init__(self, uid, save_dir, method, cookie, downloader=None, post_workers=4, queue_size=20,
+                 api_limiter=None, stop_after_known=5, profile_cache=None):
         self.uid = uid
         self.save_dir = save_dir
-        self.interval = interval
-        self.client = WeiboClient(uid, cookie)
-        self.url_manager = URLManager()
+        self.post_workers = post_workers  # 并发保存微博的消费者线程数
+        self.queue_size = queue_size  # 待保存队列上限，队列满时翻页线程等待
+        self.stop_after_known = stop_after_known  # 增量模式下连续遇到多少条已保存微博后停止
+        self.client = WeiboClient(uid, cookie, downloader, api_limiter, profile_cache)
         self.file_manager = FileManager(save_dir)
-        self.saved_urls_file = os.path.join(save_dir, "saved_urls.log")
-        self.unsaved_urls_file = os.path.join(save_dir, "unsaved_urls.log")
-        if not os.path.exists(self.unsaved_urls_file):
-            open(self.unsaved_urls_file, "w", encoding="utf-8").close()
-        for url in FileManager.load_urls(self.saved_urls_file):
-            self.url_manager.add_url(url)
-        self.unsaved_set = set(FileManager.load_urls(self.unsaved_urls_file))
-        cutoff_time = self.file_manager.read_date_log_first_line()  # 读取 date.log 第一行作为截止时间
-        self.processor = DynamicProcessor(self.file_manager, self.client, self.url_manager, cutoff_time, method)
+        self.store = StateStore(save_dir)
+        cutoff_time = self.store.newest_publish_time()
+        self.processor = DynamicProcessor(self.file_manager, self.client, self.store, cutoff_time, method)
+        self._lock = threading.Lock()
+        self.stats = {'total': 0, 'success': 0, 'skipped': 0, 'failed': 0, 'throttled': False, 'elapsed': 0.0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+        if key != 'total':
+            METRICS.inc("weibo_posts_total", result=key)
+
+    def _start_page(self):
+        """backfill 从上次回溯停下的页开始，其他模式从第一页开始，返回 None 表示无需抓取"""
+        if self.processor.method != 'backfill':
+            return 1
+        page, oldest_time, complete = self.store.history_cursor()
+        if complete:
+            logging.info("历史微博已全部回溯完成，无需 backfill")
+            return None
+        if not page:
+            return 1
+        logging.info(f"从第 {page} 页继续回溯（已覆盖到 {oldest_time}）")
+        return page
+
+    def _produce(self, containerid, post_queue):
+        """翻页线程：按接口间隔获取并解析微博，把需要保存的放入队列"""
+        method = self.processor.method
+        page = self._start_page()
+        if page is None:
+            return
+        contiguous = page == 1  # 与已覆盖的历史相连时才能推进回溯游标
+        # 有微博被日期范围筛掉或只保存了部分媒体的页不算完整覆盖：从这一页起不再推进回溯游标，
+        # 覆盖记录也停在它之前，之后不带筛选的 backfill / 增量抓取会重新检查这些微博
+        partial = bool(MEDIA_FILTER and MEDIA_FILTER.partial)
+        coverage = {'first': page, 'last': None, 'newest': None, 'oldest': None, 'end': False}
+        # 翻页时新微博会把上一页末尾的几条挤到下一页，只需记住最近入队的若干条；
+        # 置顶微博会在很后面的页再次出现，单独记住（数量很少）
+        queued = RecentKeys(self.queue_size + self.post_workers + self.DEDUP_WINDOW)
+        pinned_seen = set()
+        known_streak = 0  # 增量模式下连续已保存的条数，置顶微博不计入
+        stop = False
+        try:
+            while not stop:
+                logging.info(f"正在获取第 {page} 页数据...")
+                try:
+                    cards = self.client.fetch_list(containerid, page)
+                except WeiboThrottledError as e:
+                    logging.error(f"第 {page} 页被限流，重试后仍失败，本次抓取提前结束（并非没有更多数据）:{str(e)}")
+                    self.stats['throttled'] = True
+                    return
+                if not cards:
+                    logging.info("没有更多数据")
+                    coverage['end'] = True
+                    return
+
+                with METRICS.timer("weibo_page_parse_seconds"):
+                    weibos = [self.client.parse_weibo(card) for card in cards if card.get('card_type') == 9]
+                    weibos = [weibo for weibo in weibos if weibo]
+                if not contiguous:
+                    # 上次回溯后若有微博被删除，后面的微博会前移，起点页可能已越过未覆盖的部分
+                    times = [weibo.publish_time for weibo in weibos if not weibo.pinned]
+                    history_oldest = self.store.history_cursor()[1]
+                    if page > 1 and times and history_oldest and max(times) < history_oldest:
+                        page = max(1, page - self.BACKFILL_STEP_BACK)
+                        coverage['first'] = page
+                        logging.info(f"回溯起点与已覆盖历史之间有空隙，回退到第 {page} 页")
+                        continue
+                    contiguous = True
+
+                page_times = []
+                for weibo in weibos:
+                    if weibo.url in queued or weibo.url in pinned_seen:
+                        continue
+                    self._count('total')
+                    if not weibo.pinned:
+                        page_times.append(weibo.publish_time)
+                    action = self.processor.check_dynamic(weibo)
+                    if action == 'stop':
+                        logging.info("停止爬取")
+                        if MEDIA_FILTER and MEDIA_FILTER.date_position(weibo.publish_time) < 0:
+                            partial = True  # 因 --since 停止，本页更早的微博没有保存
+                        stop = True
+                        break
+                    if action == 'filtered':
+                        partial = True
+                        self._count('skipped')
+                        continue
+                    if action == 'skip':
+                        self._count('skipped')
+                        if method == 'incremental' and not weibo.pinned:
+                            known_streak += 1
+                            if known_streak >= self.stop_after_known:
+                                logging.info(f"连续 {known_streak} 条已保存，增量抓取结束")
+                                stop = True
+                                break
+                        continue
+                    known_streak = 0
+                    if weibo.pinned:
+                        pinned_seen.add(weibo.url)
+                    else:
+                        queued.add(weibo.url)
+                    post_queue.put(weibo)  # 队列满时阻塞，避免翻页远远领先下载
+                if MEDIA_FILTER and MEDIA_FILTER.exhausted:
+                    logging.info("本次运行的下载字节预算已用完，停止爬取")
+                    stop = True
+
+                if not partial:
+                    if page_times:
+                        coverage['newest'] = max([coverage['newest'] or page_times[0]] + page_times)
+                        coverage['oldest'] = min([coverage['oldest'] or page_times[0]] + page_times)
+                    coverage['last'] = page
+                    if contiguous:
+                        self.store.advance_history(page, coverage['oldest'])
+                page += 1
+        finally:
+            if coverage['last'] is not None:
+                self.store.record_coverage(method, coverage['first'], coverage['last'], coverage['newest'],
+                                           coverage['oldest'], coverage['end'] and not partial)
+            if coverage['end'] and contiguous and not partial:
+                self.store.advance_history(page - 1 if page > 1 else page, coverage['oldest'], reached_end=True)
+
+    def _consume(self, post_queue):
+        """保存线程：从队列取出微博并下载保存"""
+        set_log_uid(self.uid)
+        while True:
+            weibo = post_queue.get()
+            if weibo is None:
+                return
+            try:
+                if self.processor.save_dynamic(weibo):
+                    self._count('success')
+                else:
+                    self.store.mark_failed(weibo.url, weibo.publish_time)
+                    self._count('failed')
+            except MediaBudgetExceeded as e:
+                # 记入失败列表，之后由 retry 或下次运行补上，不算作失败
+                logging.info(f"下载字节预算已用完，留到下次运行:{weibo.url}（{str(e)}）")
+                self.store.mark_failed(weibo.url, weibo.publish_time)
+                self._count('skipped')
+            except Exception as e:
+                logging.error(f"保存异常:{str(e)}")
+                self.store.mark_failed(weibo.url, weibo.publish_time)
+                self._count('failed')
 
     def crawl(self):
-        containerid = self.client.get_containerid()
+        try:
+            containerid = self.client.get_containerid()
+        except WeiboThrottledError as e:
+            logging.error(f"获取 containerid 被限流:{str(e)}")
+            self.stats['throttled'] = True
+            self.store.close()
+            return self.stats
         if not containerid:
             logging.error("无法获取 containerid,请检查 Cookie 和 用户ID")
-            return
+            self.store.close()
+            return None
 
-        total = 0
-        success = 0
-        failed = 0
-        page = 1
         start_time = time.time()
-        stop_crawling = False  # 新增停止标志
+        post_queue = queue.Queue(maxsize=self.queue_size)
+        consumers = [
+            threading.Thread(target=self._consume, args=(post_queue,), name=f"save-{self.uid}-{i}", daemon=True)
+            for i in range(self.post_workers)
+        ]
+        for consumer in consumers:
+            consumer.start()
+        try:
+            self._produce(containerid, post_queue)
+        finally:
+            for _ in consumers:
+                post_queue.put(None)
+            for consumer in consumers:
+                consumer.join()
 
-        while not stop_crawling:  # 修改循环条件
-            logging.info(f"正在获取第 {page} 页数据...")
-            cards = self.client.fetch_list(containerid, page)
-            if not cards:
-                logging.info("没有更多数据")
-                break
+        self.store.update_high_water()
+        self.store.close()
+        self.stats['elapsed'] = time.time() - start_time
+        return self.stats
 
-            for card in cards:
-                if stop_crawling:  # 检查是否应该停止
-                    break
-                if card.get('card_type') != 9:
-                    continue
-                weibo = self.client.parse_weibo(card)
-                if not weibo:
-                    continue
-                total += 1
-                try:
-                    process_result = self.processor.process_dynamic(weibo)
-                    if process_result is False:
-                        if self.processor.method == 'date':
-                            logging.info(f"达到截止时间 {self.processor.cutoff_time}，停止爬取")
-                            stop_crawling = True  # 设置停止标志
-                            break  # 跳出当前页的卡片循环
-                    if process_result:  # 处理成功时更新成功计数
-                        if weibo['url'] in self.unsaved_set:
-                            self.unsaved_set.remove(weibo['url'])
-                            FileManager.update_unsaved_file(self.unsaved_urls_file, self.unsaved_set)
-                        success += 1
-                        time.sleep(self.interval)
-                except Exception as e:
-                    logging.error(f"保存异常:{str(e)}")
-                    failed += 1
-                    if weibo['url'] not in self.unsaved_set:
-                        self.unsaved_set.add(weibo['url'])
-                        FileManager.update_unsaved_file(self.unsaved_urls_file, self.unsaved_set)
-
-            if stop_crawling:  # 跳出外层循环
-                break
-            page += 1
-            time.sleep(self.interval + 2)
+class CrawlScheduler:
+    """多 UID 并发抓取调度器，所有账号共享接口限速器和 CDN 限速器"""
+    def __init__(self, config, method, downloader, api_limiter, progress_interval=30):
+        self.config = config
+        self.method = method
+        self.downloader = downloader
+        self.api_limiter = api_limiter
+        self.progress_interval = progress_interval  # 打印进度的间隔（秒）
+        self.crawlers = {}  # uid -> 正在或已经运行的 WeiboCrawler
+        self.results = {}  # uid -> 统计结果，None 表示未能完成
+
+    def _crawl_one(self, uid):
+        set_log_uid(uid)
+        try:
+            client = WeiboClient(uid, self.config.COOKIE, self.downloader, self.api_limiter,
+                                 self.config.profile_cache)
+            user_save_dir = self.config.account_dirs.resolve(uid, client.get_user_screen_name)
+            register_uid_log(uid, user_save_dir)
+            crawler = WeiboCrawler(uid, user_save_dir, self.method, self.config.COOKIE,
+                                   self.downloader, self.config.post_workers, api_limiter=self.api_limiter,
+                                   stop_after_known=self.config.stop_after_known,
+                                   profile_cache=self.config.profile_cache)
+            self.crawlers[uid] = crawler
+            return crawler.crawl()
+        finally:
+            close_uid_log(uid)
+            set_log_uid(None)
 
-        # 爬取结束后对 date.log 进行排序
-        self.file_manager.sort_date_log()
+    def _log_progress(self, total):
+        logging.info(f"====== 进度 {len(self.results)}/{total} 个账号完成 ======")
+        for uid, crawler in list(self.crawlers.items()):
+            if uid in self.results:
+                continue
+            stats = crawler.stats
+            logging.info(f"[{uid}] 处理 {stats['total']} 成功 {stats['success']} "
+                         f"跳过 {stats['skipped']} 失败 {stats['failed']}")
+        METRICS.write_prometheus()
 
-        elapsed = time.time() - start_time
+    def _log_summary(self, uid_list, elapsed):
+        totals = {'total': 0, 'success': 0, 'skipped': 0, 'failed': 0}
         logging.info("\n====== 统计结果 ======")
-        logging.info(f"总计处理:{total} 条")
-        logging.info(f"成功保存:{success} 条")
-        logging.info(f"失败数量:{failed} 条")
+        for uid in uid_list:
+            stats = self.results.get(uid)
+            if stats is None:
+                logging.info(f"[{uid}] 未完成（无法获取 containerid 或抓取异常）")
+                continue
+            note = "，被限流提前结束" if stats['throttled'] else ""
+            logging.info(f"[{uid}] 处理 {stats['total']} 成功 {stats['success']} 跳过 {stats['skipped']} "
+                         f"失败 {stats['failed']} 耗时 {stats['elapsed']:.2f} 秒{note}")
+            for key in totals:
+                totals[key] += stats[key]
+        logging.info(f"账号数:{len(uid_list)}")
+        logging.info(f"总计处理:{totals['total']} 条")
+        logging.info(f"成功保存:{totals['success']} 条")
+        logging.info(f"已保存或筛选跳过:{totals['skipped']} 条")
+        logging.info(f"失败数量:{totals['failed']} 条")
         logging.info(f"耗时:{elapsed:.2f} 秒")
+        if CREDENTIALS:
+            for line in CREDENTIALS.summary():
+                logging.info(line)
+        elif isinstance(self.api_limiter, AdaptiveRateLimiter):
+            metrics = self.api_limiter.metrics()
+            logging.info(f"接口速率:{metrics['current_rate']} 次/秒，限流 {metrics['throttle_events']} 次，"
+                         f"退避等待 {metrics['throttled_seconds']} 秒")
+        api_pools = [credential.pool for credential in CREDENTIALS.credentials] if CREDENTIALS else [API_POOL]
+        for pool in api_pools + [CDN_POOL]:
+            stats = pool.stats()
+            if stats['new_connections'] is None:
+                logging.info(f"{pool.name}请求:{stats['requests']} 次（HTTP/2 多路复用）")
+            else:
+                logging.info(f"{pool.name}请求:{stats['requests']} 次，新建连接 {stats['new_connections']} 个，"
+                             f"复用连接 {stats['reused']} 次")
+        media_filter = self.config.media_filter
+        if media_filter and media_filter.byte_budget:
+            note = "，已用完" if media_filter.exhausted else ""
+            logging.info(f"字节预算:已用 {media_filter.bytes_reserved / 1048576:.1f} MB / "
+                         f"{media_filter.byte_budget / 1048576:.1f} MB{note}")
+        if POST_PROCESSOR:
+            for line in POST_PROCESSOR.summary():
+                logging.info(line)
+        media_store = self.downloader.media_store
+        if media_store:
+            logging.info(f"媒体去重:复用 {media_store.hits} 个文件，节省 {media_store.bytes_saved / 1048576:.1f} MB")
+        parse_seconds = METRICS.total("weibo_api_parse_seconds") + METRICS.total("weibo_page_parse_seconds")
+        logging.info(f"阶段耗时（各线程累计）:接口 {METRICS.total('weibo_api_request_seconds'):.1f} 秒，"
+                     f"解析 {parse_seconds:.1f} 秒，媒体下载 {METRICS.total('weibo_media_download_seconds'):.1f} 秒"
+                     f"（{METRICS.total('weibo_media_bytes_total') / 1048576:.1f} MB），"
+                     f"写盘 {METRICS.total('weibo_disk_write_seconds'):.1f} 秒，"
+                     f"限速等待 {METRICS.total('weibo_sleep_seconds_total', reason='rate_limit'):.1f} 秒，"
+                     f"退避等待 {METRICS.total('weibo_sleep_seconds_total', reason='backoff'):.1f} 秒，"
+                     f"接口重试 {METRICS.total('weibo_api_retries_total'):g} 次")
+        METRICS.write_prometheus()
+
+    def run(self):
+        start_time = time.time()
+        uid_list = list(self.config.uid_list)
+        with ThreadPoolExecutor(max_workers=self.config.uid_workers, thread_name_prefix="uid") as executor:
+            pending = {executor.submit(self._crawl_one, uid): uid for uid in uid_list}
+            while pending:
+                finished, _ = wait(pending, timeout=self.progress_interval, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    uid = pending.pop(future)
+                    try:
+                        self.results[uid] = future.result()
+                    except Exception as e:
+                        logging.error(f"[{uid}] 抓取异常:{str(e)}")
+                        self.results[uid] = None
+                    print(f"UID {uid} 完成 ({len(self.results)}/{len(uid_list)})")
+                if not finished:
+                    self._log_progress(len(uid_list))
+        self._log_summary(uid_list, time.time() - start_time)
+        return self.results
+
+class RetryEngine:
+    """跨账号批量重试失败微博：所有到期的 bid 放进同一个线程池，共享接口限速器，状态按批提交"""
+    BACKOFF_BASE = 600  # 第一次失败后至少等待的秒数，之后每失败一次翻倍
+    BACKOFF_MAX = 86400
+    COMMIT_BATCH = 50  # 每个账号累计多少次状态写入提交一次
+
+    def __init__(self, config, downloader, api_limiter):
+        self.config = config
+        self.downloader = downloader
+        self.api_limiter = api_limiter
+        self.throttled = threading.Event()
+        self.stats = {'saved': 0, 'failed': 0, 'gone': 0, 'deferred': 0}
+        self._lock = threading.Lock()
+
+    def find_user_dirs(self):
+        """只扫描 base_dir 第一层，找出有状态库或旧版失败日志的账号文件夹"""
+        user_dirs = []
+        with os.scandir(self.config.base_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir() or entry.name.startswith('.'):
+                    continue
+                if os.path.exists(os.path.join(entry.path, StateStore.DB_NAME)) or \
+                        os.path.exists(os.path.join(entry.path, "unsaved_urls.log")):
+                    user_dirs.append(entry.path)
+        return sorted(user_dirs)
+
+    def backoff(self, attempts):
+        """累计失败 attempts 次后距下次重试的秒数"""
+        return min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** max(attempts - 1, 0))
+
+    def run(self):
+        start_time = time.time()
+        accounts = []
+        jobs = []
+        for user_dir in self.find_user_dirs():
+            store = StateStore(user_dir)
+            due = store.due_failed(self.config.retry_max_attempts)
+            if not due:
+                store.close()
+                continue
+            store.commit_every = self.COMMIT_BATCH
+            uid = os.path.basename(user_dir).split('_')[-1]
+            register_uid_log(uid, user_dir)
+            client = WeiboClient(uid, self.config.COOKIE, self.downloader, self.api_limiter, self.config.profile_cache)
+            accounts.append(store)
+            jobs.extend((client, store, url, attempts) for url, attempts in due)
+        print(f"共 {len(jobs)} 条失败微博待重试，涉及 {len(accounts)} 个账号")
+        try:
+            with ThreadPoolExecutor(max_workers=self.config.retry_workers) as executor:
+                for future in [executor.submit(self.retry_one, *job) for job in jobs]:
+                    future.result()
+        finally:
+            for store in accounts:
+                store.close()
+                close_uid_log(os.path.basename(store.save_dir).split('_')[-1])
+        elapsed = time.time() - start_time
+        print(f"重试完成: 成功 {self.stats['saved']}，失败 {self.stats['failed']}，已删除 {self.stats['gone']}，"
+              f"因限流推迟 {self.stats['deferred']}，耗时 {elapsed:.1f} 秒")
+        return self.stats
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+        METRICS.inc("weibo_retry_posts_total", result=key)
+
+    def retry_one(self, client, store, url, attempts):
+        """重试单条失败微博；接口已被限流时不再发请求，留到下次运行"""
+        set_log_uid(client.uid)
+        bid = extract_bid_from_url(url)
+        if not bid or self.throttled.is_set() or (MEDIA_FILTER and MEDIA_FILTER.exhausted):
+            self._count('deferred')
+            return
+        try:
+            weibo = client.get_weibo_by_bid(bid)
+        except WeiboPostGoneError as e:
+            logging.warning(f"微博已删除，不再重试:{str(e)}")
+            store.mark_gone(bid)
+            self._count('gone')
+            return
+        except WeiboThrottledError as e:
+            logging.error(f"接口被限流，停止本轮重试:{str(e)}")
+            self.throttled.set()
+            self._count('deferred')
+            return
+        try:
+            saved = weibo and client.save_weibo(weibo, store.save_dir, store)
+        except MediaBudgetExceeded:
+            self._count('deferred')
+            return
+        except Exception as e:
+            logging.error(f"保存异常:{str(e)}")  # 按失败退避，不中断整轮重试
+            saved = False
+        if saved:
+            store.mark_saved(weibo)
+            logging.info(f"成功保存:{url}")
+            self._count('saved')
+        else:
+            store.mark_failed(url, retry_after=self.backoff(attempts + 1))
+            logging.error(f"保存失败:{url}")
+            self._count('failed')
+
+class IngestEngine:
+    """按 bid 批量抓取指定微博，不翻时间线：输入是 weibo.com 链接或 bid，每行一条，可来自文件或标准输入
+
+    输入按批读取，每批先对照状态库去掉已保存的，再用线程池并发请求 statuses/show（共享接口限速器），
+    结果按微博作者存进各自的账号文件夹，与抓取和重试共用 save_weibo。作者已知时失败记入其状态库，
+    由 retry 子命令重试；作者还没有账号文件夹的写入 base_dir/ingest_failed-时间.txt，可再次导入。
+    """
+    COMMIT_BATCH = 50  # 每个账号累计多少次状态写入提交一次
+
+    def __init__(self, config, downloader, api_limiter):
+        self.config = config
+        self.downloader = downloader
+        self.api_limiter = api_limiter
+        self.client = WeiboClient(None, config.COOKIE, downloader, api_limiter, config.profile_cache)
+        self.throttled = threading.Event()
+        self.stats = {'saved': 0, 'skipped': 0, 'failed': 0, 'gone': 0, 'deferred': 0}
+        self._stores = {}  # uid -> StateStore，只为本次遇到或需要查重的账号打开
+        self._all_opened = False
+        self._lock = threading.Lock()
+        self._failed_file = None
+
+    @staticmethod
+    def parse_line(line):
+        """从一行输入取出 (uid, bid)，链接中没有 UID（如只给了 bid）时 uid 为 None，无法识别时返回 None"""
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return None
+        if '/' not in line:
+            return None, line
+        bid = extract_bid_from_url(line)
+        if not bid:
+            return None
+        uid = urlparse(line).path.split('/')[1]
+        return (uid if uid.isdigit() else None), bid
+
+    def _open_store_locked(self, uid, save_dir):
+        store = self._stores.get(uid)
+        if store is None:
+            store = self._stores[uid] = StateStore(save_dir)
+            store.commit_every = self.COMMIT_BATCH
+            register_uid_log(uid, save_dir)
+        return store
+
+    def _existing_store(self, uid):
+        """已有账号文件夹的状态库，账号从未保存过时返回 None，不发任何请求"""
+        with self._lock:
+            if uid in self._stores:
+                return self._stores[uid]
+            save_dir = self.config.account_dirs.find(uid)
+            return self._open_store_locked(uid, save_dir) if save_dir else None
+
+    def _account_store(self, uid):
+        """微博作者的状态库，没有账号文件夹时按昵称新建"""
+        store = self._existing_store(uid)
+        if store:
+            return store
+        name_fn = WeiboClient(uid, self.config.COOKIE, self.downloader, self.api_limiter,
+                              self.config.profile_cache).get_user_screen_name
+        save_dir = self.config.account_dirs.resolve(uid, name_fn)
+        with self._lock:
+            return self._open_store_locked(uid, save_dir)
+
+    def is_saved(self, uid, bid):
+        """作者已知时只查该账号；只有 bid 时查所有账号（首次用到时打开全部状态库）"""
+        if uid:
+            store = self._existing_store(uid)
+            return bool(store and store.is_saved(bid))
+        with self._lock:
+            if not self._all_opened:
+                for known_uid, save_dir in self.config.account_dirs.existing().items():
+                    if os.path.exists(os.path.join(save_dir, StateStore.DB_NAME)):
+                        self._open_store_locked(known_uid, save_dir)
+                self._all_opened = True
+            stores = list(self._stores.values())
+        return any(store.is_saved(bid) for store in stores)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+        METRICS.inc("weibo_ingest_posts_total", result=key)
+
+    def _record_failure(self, uid, bid, publish_time=None):
+        """作者有账号文件夹时记入状态库等待 retry，否则写入失败文件，不为此新建文件夹或发请求"""
+        url = f"https://weibo.com/{uid}/{bid}" if uid else bid
+        store = self._existing_store(uid) if uid else None
+        if store:
+            store.mark_failed(url, publish_time)
+            return
+        with self._lock:
+            if self._failed_file is None:
+                # 文件名带时间，再次导入失败文件时不会边读边写同一个文件
+                name = f"ingest_failed-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+                self._failed_file = open(os.path.join(self.config.base_dir, name), 'a', encoding='utf-8')
+            self._failed_file.write(url + "\n")
+
+    def fetch_one(self, uid, bid):
+        set_log_uid(uid)
+        if self.throttled.is_set() or (MEDIA_FILTER and MEDIA_FILTER.exhausted):
+            self._record_failure(uid, bid)
+            self._count('deferred')
+            return
+        try:
+            weibo = self.client.get_weibo_by_bid(bid)
+        except WeiboPostGoneError as e:
+            logging.warning(f"微博已删除:{str(e)}")
+            store = self._existing_store(uid) if uid else None
+            if store:
+                store.mark_gone(bid)
+            self._count('gone')
+            return
+        except WeiboThrottledError as e:
+            logging.error(f"接口被限流，剩余的微博留到下次:{str(e)}")
+            self.throttled.set()
+            self._record_failure(uid, bid)
+            self._count('deferred')
+            return
+        if not weibo:
+            self._record_failure(uid, bid)
+            self._count('failed')
+            return
+        author = urlparse(weibo.url).path.split('/')[1]  # 输入的 UID 可能缺失或有误，以接口返回的作者为准
+        author = author if author.isdigit() else uid
+        if not author:
+            self._record_failure(None, bid)
+            self._count('failed')
+            return
+        set_log_uid(author)
+        store = self._account_store(author)
+        if store.is_saved(weibo.bid) or (MEDIA_FILTER and MEDIA_FILTER.date_position(weibo.publish_time)):
+            self._count('skipped')  # 输入的是数字 id 时发请求前查不出已保存
+            return
+        try:
+            saved = self.client.save_weibo(weibo, store.save_dir, store)
+        except MediaBudgetExceeded:
+            self._record_failure(author, weibo.bid, weibo.publish_time)
+            self._count('deferred')
+            return
+        except Exception as e:
+            logging.error(f"保存异常:{str(e)}")  # 记入状态库等待 retry，不中断这一批
+            saved = False
+        if saved:
+            store.mark_saved(weibo)
+            logging.info(f"成功保存:{weibo.url}")
+            self._count('saved')
+        else:
+            store.mark_failed(weibo.url, weibo.publish_time)
+            logging.error(f"保存失败:{weibo.url}")
+            self._count('failed')
+
+    @staticmethod
+    def batches(lines, batch_size):
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run(self, lines):
+        """处理输入的每一行，每批结束打印吞吐和失败数，返回累计统计"""
+        start_time = time.time()
+        lines = iter(lines)  # 被限流提前结束时从停下的位置继续读出剩余输入
+        seen = set()  # 只存本次输入中的 bid，用于去掉输入里的重复行
+        try:
+            with ThreadPoolExecutor(max_workers=self.config.ingest_workers) as executor:
+                for number, batch in enumerate(self.batches(lines, self.config.ingest_batch_size), start=1):
+                    batch_start = time.time()
+                    before = dict(self.stats)
+                    jobs = []
+                    for line in batch:
+                        parsed = self.parse_line(line)
+                        if not parsed or parsed[1] in seen:
+                            continue
+                        seen.add(parsed[1])
+                        if self.is_saved(*parsed):
+                            self._count('skipped')
+                        else:
+                            jobs.append(parsed)
+                    for future in [executor.submit(self.fetch_one, uid, bid) for uid, bid in jobs]:
+                        future.result()
+                    for store in list(self._stores.values()):
+                        store.flush()
+                    delta = {key: self.stats[key] - before[key] for key in self.stats}
+                    elapsed = max(time.time() - batch_start, 1e-6)
+                    print(f"第 {number} 批:请求 {len(jobs)} 条，保存 {delta['saved']}，已保存跳过 {delta['skipped']}，"
+                          f"失败 {delta['failed']}，已删除 {delta['gone']}，推迟 {delta['deferred']}，"
+                          f"{len(jobs) / elapsed:.1f} 条/秒")
+                    if self.throttled.is_set():
+                        # 剩余输入不再请求，与上面一样去掉重复行和已保存的，其余记下，下次接着导入
+                        for uid, bid in filter(None, map(self.parse_line, lines)):
+                            if bid in seen:
+                                continue
+                            seen.add(bid)
+                            if self.is_saved(uid, bid):
+                                self._count('skipped')
+                                continue
+                            self._record_failure(uid, bid)
+                            self._count('deferred')
+                        break
+        finally:
+            for uid, store in self._stores.items():
+                store.close()
+                close_uid_log(uid)
+            if self._failed_file:
+                self._failed_file.close()
+        elapsed = time.time() - start_time
+        print(f"导入完成: 保存 {self.stats['saved']}，已保存跳过 {self.stats['skipped']}，失败 {self.stats['failed']}，"
+              f"已删除 {self.stats['gone']}，推迟 {self.stats['deferred']}，耗时 {elapsed:.1f} 秒")
+        if self._failed_file:
+            print(f"未能记入状态库的微博已写入 {self._failed_file.name}，可再次导入")
+        return self.stats
 
 class OperationMenu:
     def __init__(self, config):
         self.config = config
+        # CDN 连接池按单主机并发设置，接口连接池按同时抓取的账号数设置
+        configure_http_pools(api_pool_size=config.uid_workers + 1, cdn_pool_size=config.per_host_limit,
+                             http2=config.http2)
+        configure_card_parser(config.stream_json)
+        credentials = configure_credentials(config.cookies, config.api_rate, config.api_max_rate,
+                                            config.uid_workers + 1, config.http2, config.cookie_strategy)
+        if credentials:
+            logging.info(f"凭据池:{len(config.cookies)} 个 Cookie，{config.cookie_strategy} 调度，"
+                         f"每个 Cookie 初始 {config.api_rate:.2f} 次/秒")
+        METRICS.configure(config.metrics_file, config.prometheus_file, config.prometheus_port)
+        configure_media_filter(config.media_filter)
+        configure_output(config.text_files, config.post_manifest)
+        if not config.text_files and not config.post_manifest:
+            logging.warning("text_files 和 post_manifest 都已关闭，不会保存微博正文")
+        self.post_processor = None
+        if config.verify_media or config.transcode_images or config.remux_live:
+            self.post_processor = MediaPostProcessor(config.verify_workers, config.verify_decode,
+                                                     config.transcode_images, config.remux_live,
+                                                     verify=config.verify_media)
+        configure_post_processor(self.post_processor)
+        self.api_limiter = AdaptiveRateLimiter(config.api_rate, max_rate=config.api_max_rate)
+        self.media_limiter = TokenBucket(config.media_rate, capacity=max(1, int(config.media_rate)), name="media")
+        self.media_store = MediaStore(config.base_dir) if config.dedup_media else None
+        self.downloader = MediaDownloader(config.download_workers, config.per_host_limit, self.media_limiter,
+                                          config.chunk_size, self.media_store)
 
     def run(self):
         while True:
@@ -514,72 +3141,74 @@ class OperationMenu:
                 "1. 开始新抓取\n"
                 "2. 重试失败URL\n"
                 "3. 退出\n"
-                "4. 修改UID\n请输入数字: "
+                "4. 修改UID\n"
+                "5. 按链接列表批量抓取\n请输入数字: "
             ).strip()
             if choice == "1":
                 method_choice = input(
                     "请选择保存方法:\n"
-                    "1. 使用 date.log 截止日期停止，不检查 saved_urls.log\n"
-                    "2. 检查 saved_urls.log，不使用 date.log 截止日期\n"
+                    "1. 遇到最新已保存微博的发布时间即停止\n"
+                    "2. 逐条检查是否已保存，跳过已保存的微博\n"
+                    "3. 增量抓取：连续遇到若干条已保存微博即停止\n"
+                    "4. 回溯抓取：从上次历史扫描停下的位置继续向前\n"
                     "请输入数字: "
                 ).strip()
                 if method_choice == "1":
                     method = 'date'
                 elif method_choice == "2":
                     method = 'url'
+                elif method_choice == "3":
+                    method = 'incremental'
+                elif method_choice == "4":
+                    method = 'backfill'
                 else:
                     print("无效选择，默认使用方法1")
                     method = 'date'
 
-                for uid in self.config.uid_list:
-                    print(f"\n开始下载UID: {uid}")
-                    self.config.update_for_uid(uid)
-                    client = WeiboClient(uid, self.config.COOKIE)
-                    screen_name = client.get_user_screen_name() or f"unknown_{uid}"
-                    folder_name = f"{WeiboUtils.get_valid_filename(screen_name)}_{uid}"
-                    user_save_dir = os.path.join(self.config.base_dir, folder_name)
-                    os.makedirs(user_save_dir, exist_ok=True)
-                    setup_logger(user_save_dir)
-                    crawler = WeiboCrawler(uid, user_save_dir, self.config.interval, method, self.config.COOKIE)
-                    crawler.crawl()
-                    long_interval = 4.44
-                    print("\n")
-                    print("开始尖端科技之time.sleep", long_interval, "秒")
-                    print("\n")
-                    time.sleep(long_interval)
+                self.crawl(method)
             elif choice == "2":
-                for root, dirs, files in os.walk(self.config.base_dir):
-                    for dir_name in dirs:
-                        user_dir = os.path.join(root, dir_name)
-                        unsaved_file = os.path.join(user_dir, "unsaved_urls.log")
-                        if os.path.exists(unsaved_file):
-                            with open(unsaved_file, "r", encoding="utf-8") as f:
-                                unsaved_urls = [line.strip() for line in f if line.strip()]
-                            if unsaved_urls:
-                                print(f"\n重试文件夹: {dir_name} 的失败URL")
-                                uid = dir_name.split('_')[-1]
-                                client = WeiboClient(uid, self.config.COOKIE)
-                                crawler = WeiboCrawler(uid, user_dir, self.config.interval, method='url', cookie=self.config.COOKIE)
-                                for url in unsaved_urls:
-                                    bid = extract_bid_from_url(url)
-                                    if bid:
-                                        weibo = client.get_weibo_by_bid(bid)
-                                        if weibo and crawler.processor.process_dynamic(weibo):
-                                            crawler.unsaved_set.remove(url)
-                                            FileManager.update_unsaved_file(unsaved_file, crawler.unsaved_set)
-                                            FileManager.append_url(os.path.join(user_dir, "saved_urls.log"), url)
-                                            logging.info(f"成功保存:{url}")
-                                        else:
-                                            logging.error(f"保存失败:{url}")
-                                    time.sleep(self.config.interval)
+                self.retry_failed()
             elif choice == "3":
                 print("程序退出")
+                self.close()
                 break
             elif choice == "4":
                 self.change_uid()
+            elif choice == "5":
+                path = input("请输入每行一个链接或 bid 的文件路径: ").strip()
+                if os.path.isfile(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        self.ingest(f)
+                else:
+                    print("文件不存在")
             else:
                 print("无效输入，请重新选择")
 
+    def crawl(self, method):
+        """并发抓取 config.uid_list 中的全部 UID，返回每个 UID 的统计结果"""
+        print(f"\n开始并发下载 {len(self.config.uid_list)} 个 UID，同时抓取 {self.config.uid_workers} 个")
+        scheduler = CrawlScheduler(self.config, method, self.downloader, self.api_limiter)
+        return scheduler.run()
+
+    def retry_failed(self):
+        """并发重试所有账号状态库中已到重试时间的失败微博"""
+        return RetryEngine(self.config, self.downloader, self.api_limiter).run()
+
+    def ingest(self, lines):
+        """按链接或 bid 批量抓取指定微博，lines 可以是打开的文件或标准输入"""
+        return IngestEngine(self.config, self.downloader, self.api_limiter).run(lines)
+
+    def close(self):
+        self.downloader.shutdown()
+        configure_credentials()
+        if self.post_processor:
+            self.post_processor.close()
+            configure_post_processor()
+        configure_output()
+        if self.media_store:
+            self.media_store.close()
+        METRICS.close()
+
     def change_uid(self):
         new_uid_input = input("请输入新的UID（多个UID用逗号分隔）: ").strip()
         if new_uid_input:
@@ -592,36 +3221,417 @@ def extract_bid_from_url(url):
     parsed = urlparse(url)
     path_parts = parsed.path.split('/')
     if len(path_parts) >= 3 and path_parts[2]:
-        bid = path_parts[2]
-        logging.info(f"从 URL {url} 提取到的 bid: {bid}")
-        return bid
+        return path_parts[2]
     return None
 
-def setup_logger(save_dir):
-    log_file = os.path.join(save_dir, f"weibo_crawler_{datetime.now().strftime('%Y%m%d%H%M')}.log")
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        handlers=[
-            logging.FileHandler(log_file),
-            logging.StreamHandler()
-        ]
-    )
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+LOG_FILE_NAME = "weibo_crawler.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024  # 单个日志文件达到该大小后轮转
+LOG_BACKUP_COUNT = 5
+_log_uid = contextvars.ContextVar("log_uid", default=None)  # 每个线程各自独立
+_log_listener = None
+_log_queue = None
+_uid_router = None
+
+def set_log_uid(uid):
+    """标记当前线程正在处理的 UID，此后它的日志同时写入该账号目录"""
+    _log_uid.set(uid)
+
+def current_log_uid():
+    return _log_uid.get()
+
+class UidContextFilter(logging.Filter):
+    """在产生日志的线程里给记录打上 UID，供后台线程按账号分发"""
+    def filter(self, record):
+        if not hasattr(record, 'uid'):
+            record.uid = current_log_uid()
+        return True
+
+class UidLogRouter(logging.Handler):
+    """在后台日志线程中把带 UID 的记录写入对应账号目录的轮转日志"""
+    def __init__(self):
+        super().__init__()
+        self._handlers = {}
+
+    def add(self, uid, save_dir):
+        handler = logging.handlers.RotatingFileHandler(
+            os.path.join(save_dir, LOG_FILE_NAME), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+            encoding='utf-8', delay=True)
+        handler.setFormatter(self.formatter)
+        with self.lock:
+            old = self._handlers.get(uid)
+            self._handlers[uid] = handler
+        if old:
+            old.close()
+
+    def emit(self, record):
+        uid = getattr(record, 'uid', None)
+        handler = self._handlers.get(uid) if uid else None
+        if getattr(record, 'close_uid_log', False):
+            self._handlers.pop(uid, None)
+            if handler:
+                handler.close()
+        elif handler:
+            handler.emit(record)
+
+    def close(self):
+        with self.lock:
+            handlers, self._handlers = list(self._handlers.values()), {}
+        for handler in handlers:
+            handler.close()
+        super().close()
+
+def setup_logger(save_dir, level=logging.INFO):
+    """配置一次全局日志：调用线程只把记录放进队列，由后台线程写控制台和 save_dir 下的轮转日志
+
+    重复调用只调整级别，不会重复添加 handler。返回总日志文件路径。
+    """
+    global _log_listener, _log_queue, _uid_router
+    log_file = os.path.join(save_dir, LOG_FILE_NAME)
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _log_listener:
+        return log_file
+    formatter = logging.Formatter(LOG_FORMAT)
+    console = logging.StreamHandler()
+    main_file = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES,
+                                                     backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    _uid_router = UidLogRouter()
+    for handler in (console, main_file, _uid_router):
+        handler.setFormatter(formatter)
+    console.setLevel(logging.INFO)
+    main_file.setLevel(logging.DEBUG)  # 级别由根 logger 控制，这里只挡掉 close_uid_log 的内部记录
+    _log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(_log_queue)
+    queue_handler.addFilter(UidContextFilter())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    _log_listener = logging.handlers.QueueListener(_log_queue, console, main_file, _uid_router,
+                                                   respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(shutdown_logger)
     return log_file
 
-def main():
+def register_uid_log(uid, save_dir):
+    """之后标记为该 UID 的日志额外写入 save_dir 下的轮转日志"""
+    if _uid_router:
+        _uid_router.add(uid, save_dir)
+
+def close_uid_log(uid):
+    """账号处理完后关闭其日志文件；通过队列发送，排在该账号已产生的日志之后"""
+    if _log_queue is not None:
+        _log_queue.put_nowait(logging.makeLogRecord({'uid': uid, 'close_uid_log': True, 'levelno': 0}))
+
+def shutdown_logger():
+    """写完队列中剩余的日志并停止后台线程"""
+    global _log_listener
+    if _log_listener:
+        listener, _log_listener = _log_listener, None
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+CONFIG_KEYS = (
+    'uids', 'base_dir', 'interval', 'cookie_file', 'download_workers', 'per_host_limit', 'post_workers',
+    'uid_workers', 'api_rate', 'api_max_rate', 'media_rate', 'chunk_size', 'dedup_media', 'stop_after_known',
+    'http2', 'profile_ttl', 'method', 'retry_workers', 'retry_max_attempts', 'ingest_workers', 'ingest_batch_size',
+    'stream_json', 'metrics_file', 'prometheus_file', 'prometheus_port', 'log_level', 'include_media',
+    'exclude_media', 'image_size', 'max_video_resolution', 'max_video_mb', 'byte_budget_mb', 'since', 'until',
+    'cookie_strategy', 'verify_media', 'verify_decode', 'verify_workers', 'transcode_images', 'remux_live',
+    'text_files', 'post_manifest',
+)
+
+def load_config_file(path):
+    """读取 TOML（.toml）或 JSON 配置文件，只保留认识的键"""
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, 'rb') as f:
+            settings = tomllib.load(f)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+    unknown = set(settings) - set(CONFIG_KEYS)
+    if unknown:
+        logging.warning(f"配置文件中有未知的键，已忽略:{', '.join(sorted(unknown))}")
+    return {key: value for key, value in settings.items() if key in CONFIG_KEYS}
+
+def read_cookies(cookie_file=None):
+    """优先读取环境变量 WEIBO_COOKIE，其次读取 cookie 文件，都没有时返回空列表
+
+    每行一个 Cookie，多个 Cookie 组成凭据池分担接口请求；# 开头的行是注释
+    """
+    text = os.environ.get(COOKIE_ENV, "").strip()
+    if not text and cookie_file:
+        with open(os.path.expanduser(cookie_file), 'r', encoding='utf-8') as f:
+            text = f.read()
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.strip().startswith('#')]
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="微博图片下载（非交互模式），Cookie 从环境变量 "
+                                                 f"{COOKIE_ENV} 或 --cookie-file 读取")
+    parser.add_argument("-c", "--config", help="TOML 或 JSON 配置文件")
+    parser.add_argument("--uids", help="逗号分隔的 UID 列表，覆盖配置文件")
+    parser.add_argument("--base-dir", help="保存文件的基目录")
+    parser.add_argument("--cookie-file", help="保存 Cookie 的文件")
+    parser.add_argument("--uid-workers", type=int, help="同时抓取的账号数")
+    parser.add_argument("--post-workers", type=int, help="每个账号并发保存微博的线程数")
+    parser.add_argument("--download-workers", type=int, help="媒体下载线程池大小")
+    parser.add_argument("--per-host-limit", type=int, help="每个 CDN 主机的最大并发连接数")
+    parser.add_argument("--api-rate", type=float, help="接口初始速率（次/秒）")
+    parser.add_argument("--api-max-rate", type=float, help="接口自适应提速上限（次/秒），默认不超过初始速率")
+    parser.add_argument("--media-rate", type=float, help="CDN 下载限速（个文件/秒）")
+    parser.add_argument("--metrics-file", help="把每次请求、每个文件的耗时写成 JSON Lines")
+    parser.add_argument("--prometheus-file", help="运行中定期写入 Prometheus 文本格式指标")
+    parser.add_argument("--prometheus-port", type=int, help="在本地端口提供 /metrics")
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), help="日志级别，默认 INFO")
+    parser.add_argument("--cookie-strategy", choices=CredentialPool.STRATEGIES,
+                        help="有多个 Cookie 时的接口请求分配方式，默认 least-loaded")
+    parser.add_argument("--include-media", help="只下载这些类型，逗号分隔，可选 image,live,video,text")
+    parser.add_argument("--exclude-media", help="不下载这些类型，逗号分隔；live 表示实况照片的 mov")
+    parser.add_argument("--image-size", choices=MediaFilter.IMAGE_SIZES, help="图片尺寸，默认 large（原图）")
+    parser.add_argument("--max-video-resolution", type=int, help="视频清晰度上限（高度，如 720），没有合适清晰度时不下载")
+    parser.add_argument("--max-video-mb", type=float, help="跳过超过该大小的视频（MB），需要先发 HEAD 请求")
+    parser.add_argument("--byte-budget-mb", type=float, help="本次运行最多下载多少 MB，用完后停止抓取")
+    parser.add_argument("--since", help="只保存该日期（YYYY-MM-DD）及之后发布的微博")
+    parser.add_argument("--until", help="只保存该日期（YYYY-MM-DD）及之前发布的微博")
+    parser.add_argument("--verify-workers", type=int, help="下载后校验和转码的进程数")
+    parser.add_argument("--transcode-images", choices=MediaPostProcessor.IMAGE_FORMATS,
+                        help="下载后把 JPEG 转成该格式并替换原文件，需要 Pillow")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    crawl_parser = subparsers.add_parser("crawl", help="抓取 UID 列表中的新微博")
+    crawl_parser.add_argument("--method", choices=("date", "url", "incremental"), help="停止/去重方式，默认 incremental")
+    subparsers.add_parser("backfill", help="从上次历史扫描停下的位置继续向前抓取")
+    subparsers.add_parser("retry", help="重试状态库中记录的失败微博")
+    ingest_parser = subparsers.add_parser("ingest", help="按链接或 bid 列表批量抓取指定微博，不翻时间线")
+    ingest_parser.add_argument("source", help="每行一个 weibo.com 链接或 bid 的文件，- 表示标准输入")
+    ingest_parser.add_argument("--workers", type=int, help="并发请求的线程数")
+    ingest_parser.add_argument("--batch-size", type=int, help="每批读取的行数，每批结束报告一次吞吐")
+    subparsers.add_parser("stats", help="打印每个账号的保存状态，不发起网络请求")
+    subparsers.add_parser("verify", help="校验已下载的文件，损坏的删除并改回失败，之后由 retry 重新下载")
+    export_parser = subparsers.add_parser("export", help="把各账号的元数据清单 posts.jsonl 导出为一个文件")
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl",
+                               help="导出格式，txt 表示按清单补写缺少的正文文件；parquet 需要 pyarrow")
+    export_parser.add_argument("--output", help="输出文件，默认 base_dir/posts.<格式>")
+    return parser
+
+def build_config(args):
+    """合并默认值、配置文件和命令行参数（命令行优先），生成非交互 Config"""
+    settings = load_config_file(args.config) if args.config else {}
+    overrides = {
+        'base_dir': args.base_dir, 'cookie_file': args.cookie_file, 'uid_workers': args.uid_workers,
+        'post_workers': args.post_workers, 'download_workers': args.download_workers,
+        'per_host_limit': args.per_host_limit, 'api_rate': args.api_rate, 'api_max_rate': args.api_max_rate,
+        'media_rate': args.media_rate, 'metrics_file': args.metrics_file,
+        'prometheus_file': args.prometheus_file, 'prometheus_port': args.prometheus_port,
+        'log_level': args.log_level, 'include_media': args.include_media,
+        'exclude_media': args.exclude_media, 'image_size': args.image_size,
+        'max_video_resolution': args.max_video_resolution, 'max_video_mb': args.max_video_mb,
+        'byte_budget_mb': args.byte_budget_mb, 'since': args.since, 'until': args.until,
+        'cookie_strategy': args.cookie_strategy, 'verify_workers': args.verify_workers,
+        'transcode_images': args.transcode_images,
+    }
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    if args.command == "ingest":
+        settings.update({key: value for key, value in (('ingest_workers', args.workers),
+                                                       ('ingest_batch_size', args.batch_size)) if value is not None})
+    if args.uids:
+        settings['uids'] = args.uids
+    uids = settings.pop('uids', None)
+    if isinstance(uids, str):
+        uids = [uid.strip() for uid in uids.split(',') if uid.strip()]
+    cookie_file = settings.pop('cookie_file', None)
+    cookies = read_cookies(cookie_file)
+    if args.command in ("stats", "verify", "export"):
+        cookies = cookies or ["-"]  # 统计、校验和导出不请求接口，不需要 Cookie
+    if args.command not in ("crawl", "backfill"):
+        uids = uids or []  # 只有 crawl / backfill 按 UID 列表抓取，其余命令遍历 base_dir 下的账号文件夹
+    return Config(uid_list=uids, cookie=cookies[0] if cookies else None, cookies=cookies, interactive=False,
+                  **settings)
+
+def print_stats(base_dir):
+    """汇总 base_dir 下每个账号状态库中的已保存、失败数量和抓取进度"""
+    totals = {'saved': 0, 'failed': 0, 'gone': 0}
+    with os.scandir(base_dir) as entries:
+        user_dirs = sorted(entry.path for entry in entries
+                           if entry.is_dir() and os.path.exists(os.path.join(entry.path, StateStore.DB_NAME)))
+    for user_dir in user_dirs:
+        store = StateStore(user_dir)
+        saved, failed, gone = store.count('saved'), store.count('failed'), store.count('gone')
+        high_water_time = store.high_water()[1] or store.newest_publish_time() or "-"
+        history_page, history_oldest, complete = store.history_cursor()
+        history = "已到末尾" if complete else f"第 {history_page or 0} 页 / {history_oldest or '-'}"
+        print(f"{os.path.basename(user_dir)}: 已保存 {saved}，失败 {failed}，已删除 {gone}，最新 {high_water_time}，历史覆盖 {history}")
+        totals['saved'] += saved
+        totals['failed'] += failed
+        totals['gone'] += gone
+        store.close()
+    print(f"账号数:{len(user_dirs)}，已保存 {totals['saved']}，失败 {totals['failed']}，已删除 {totals['gone']}")
+
+def verify_saved(config, batch_size=500):
+    """校验 base_dir 下每个账号清单中已完成的文件，不发起网络请求
+
+    损坏的文件删除，清单改为未完成，所属微博改回失败，之后由 retry 只重新下载这些文件。返回汇总统计
+    """
+    totals = {'checked': 0, 'bad': 0, 'posts': 0}
+    processor = MediaPostProcessor(config.verify_workers, config.verify_decode)
+    media_store = MediaStore(config.base_dir) if config.dedup_media else None
+    with os.scandir(config.base_dir) as entries:
+        user_dirs = sorted(entry.path for entry in entries
+                           if entry.is_dir() and os.path.exists(os.path.join(entry.path, StateStore.DB_NAME)))
+    try:
+        for user_dir in user_dirs:
+            store = StateStore(user_dir)
+            checked = 0
+            bad_files = {}
+            for batch in store.done_files(batch_size):
+                reasons = processor.verify([path for _, path, _ in batch])
+                checked += len(batch)
+                for (bid, path, url), reason in zip(batch, reasons):
+                    if reason:
+                        logging.warning(f"文件校验失败 {path}:{reason}")
+                        processor.discard(url, path, media_store)
+                        bad_files.setdefault(bid, []).append(path)
+            # 分页按主键推进，翻完后再改清单，不影响后续批次
+            for bid, paths in bad_files.items():
+                store.requeue(bid, paths)
+            store.close()
+            bad = sum(len(paths) for paths in bad_files.values())
+            print(f"{os.path.basename(user_dir)}: 校验 {checked} 个文件，损坏 {bad} 个，涉及 {len(bad_files)} 条微博")
+            totals['checked'] += checked
+            totals['bad'] += bad
+            totals['posts'] += len(bad_files)
+    finally:
+        processor.close()
+        if media_store:
+            media_store.close()
+    print(f"账号数:{len(user_dirs)}，校验 {totals['checked']} 个文件，损坏 {totals['bad']} 个，"
+          f"{totals['posts']} 条微博已改回失败，可运行 retry 重新下载")
+    return totals
+
+EXPORT_FORMATS = ("jsonl", "csv", "parquet", "txt")
+EXPORT_COLUMNS = ('account', 'bid', 'url', 'publish_time', 'content', 'text_path', 'media', 'media_count', 'bytes')
+
+def export_row(account, record):
+    """csv / parquet 的一行：完成的媒体路径用分号连接"""
+    done = [media for media in record['media'] if media['done']]
+    return {'account': account, 'bid': record['bid'], 'url': record['url'], 'publish_time': record['publish_time'],
+            'content': record['content'], 'text_path': record['text_path'],
+            'media': ";".join(media['path'] for media in done), 'media_count': len(done),
+            'bytes': sum(media['bytes'] or 0 for media in done)}
+
+def export_manifests(base_dir, fmt="jsonl", output=None):
+    """把 base_dir 下每个账号的元数据清单合并导出，不发起网络请求，返回导出的微博数；缺少 pyarrow 时返回 None
+
+    txt 格式不生成汇总文件，而是按清单在各账号文件夹中补写缺少的正文文件
+    """
+    if fmt == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("导出 parquet 需要安装 pyarrow", file=sys.stderr)
+            return None
+    with os.scandir(base_dir) as entries:
+        user_dirs = sorted(entry.path for entry in entries
+                           if entry.is_dir() and os.path.exists(os.path.join(entry.path, PostManifest.FILE_NAME)))
+    output = output or os.path.join(base_dir, f"posts.{fmt}")
+    count = 0
+    rows = []
+    with ExitStack() as stack:
+        writer = None
+        if fmt == "jsonl":
+            writer = stack.enter_context(open(output, 'w', encoding='utf-8'))
+        elif fmt == "csv":
+            f = stack.enter_context(open(output, 'w', encoding='utf-8-sig', newline=''))  # 带 BOM，Excel 能识别中文
+            writer = csv.DictWriter(f, fieldnames=EXPORT_COLUMNS)
+            writer.writeheader()
+        for user_dir in user_dirs:
+            account = os.path.basename(user_dir)
+            records = PostManifest.records(user_dir)  # 一次只读入一个账号
+            for record in records.values():
+                if fmt == "txt":
+                    if not record['text_path']:
+                        continue
+                    txt_path = os.path.join(user_dir, record['text_path'])
+                    if os.path.exists(txt_path):
+                        continue
+                    os.makedirs(os.path.dirname(txt_path), exist_ok=True)
+                    WeiboClient.write_content(txt_path, record['content'], record['url'])
+                elif fmt == "jsonl":
+                    writer.write(json.dumps(dict(record, account=account), ensure_ascii=False) + "\n")
+                elif fmt == "csv":
+                    writer.writerow(export_row(account, record))
+                else:
+                    rows.append(export_row(account, record))
+                count += 1
+            print(f"{account}: {len(records)} 条微博")
+    if fmt == "parquet":
+        table = pyarrow.Table.from_pylist(rows, schema=pyarrow.schema([
+            (column, pyarrow.int64() if column in ('media_count', 'bytes') else pyarrow.string())
+            for column in EXPORT_COLUMNS]))
+        pyarrow.parquet.write_table(table, output)
+    if fmt == "txt":
+        print(f"账号数:{len(user_dirs)}，补写正文文件 {count} 个")
+    else:
+        print(f"账号数:{len(user_dirs)}，导出 {count} 条微博到 {output}")
+    return count
+
+def cli_main(argv):
+    """非交互入口，供 cron / systemd 定时运行；有账号失败或被限流时返回 1"""
+    args = build_arg_parser().parse_args(argv)
+    try:
+        config = build_config(args)
+    except (OSError, ValueError) as e:
+        print(f"配置错误:{e}", file=sys.stderr)
+        return 2
+    if args.command == "ingest" and args.source != "-" and not os.path.isfile(args.source):
+        print(f"配置错误:找不到输入文件 {args.source}", file=sys.stderr)
+        return 2
+    setup_logger(config.base_dir, config.log_level)
+    if args.command == "stats":
+        print_stats(config.base_dir)
+        return 0
+    if args.command == "verify":
+        return 1 if verify_saved(config)['bad'] else 0
+    if args.command == "export":
+        return 0 if export_manifests(config.base_dir, args.format, args.output) is not None else 2
+    menu = OperationMenu(config)
+    try:
+        if args.command == "retry":
+            stats = menu.retry_failed()
+            return 1 if stats['failed'] or stats['deferred'] else 0
+        if args.command == "ingest":
+            if args.source == "-":
+                stats = menu.ingest(sys.stdin)
+            else:
+                with open(args.source, 'r', encoding='utf-8') as f:
+                    stats = menu.ingest(f)
+            return 1 if stats['failed'] or stats['deferred'] else 0
+        if args.command == "backfill":
+            method = 'backfill'
+        else:
+            method = args.method or config.method
+        results = menu.crawl(method)
+        failed = [uid for uid, stats in results.items() if stats is None or stats['throttled']]
+        return 1 if failed else 0
+    finally:
+        menu.close()
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return cli_main(argv)
+
     print("这是微博爬取的程序")
     print("Kitaro绮太郎1923024604 半年可见")
     print("坂坂白 5491928243 半年可见\n")
 
     config = Config()
-    SESSION.headers.update({
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0',
-        'Cookie': config.COOKIE
-    })
+    setup_logger(config.base_dir, config.log_level)
 
     menu = OperationMenu(config)
     menu.run()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())